@@ -1,25 +1,45 @@
-from typing import Optional, List
+from typing import Optional, List, Dict
 import logging
+import json
 import time
 import os
-import re
 
 from discord import app_commands
 import asyncio
 import discord
 
-from diffuser_discord.bot.image_client import ImageClient, BLANK_IMAGE
+from diffuser_discord.bot.image_client import ImageClient, ImageProgress, BLANK_IMAGE, ERROR_IMAGE
+from diffuser_discord.bot.http_server import HTTPServer
+from diffuser_discord.bot.templates import PromptTemplate
+from diffuser_discord.bot.fair_queue import FairScheduler
+from diffuser_discord.bot.job_queue import JobQueue, JobRunner, JobListener
+from diffuser_discord.bot.message_updater import MessageUpdater, MessageTarget
+from diffuser_discord.bot import metrics
 
 
 SYNC_GUILD = os.environ.get("SYNC_GUILD", None)
+PROGRESS_UPDATE_INTERVAL = float(os.environ.get("PROGRESS_UPDATE_INTERVAL", "2.0"))
+MAX_PROMPTS = int(os.environ.get("MAX_PROMPTS", "16"))
+MAX_TEMPLATE_COMBINATIONS = int(os.environ.get("MAX_TEMPLATE_COMBINATIONS", "10000"))
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "2"))
+MAX_JOBS_PER_USER = int(os.environ.get("MAX_JOBS_PER_USER", "1"))
+# optional jsonl file of every generation request, replayable with scripts/bench_replay.py
+REQUEST_LOG = os.environ.get("REQUEST_LOG", None)
 
 
 class DiscordClient(discord.Client):
-    def __init__(self, *, intents: discord.Intents):
+    def __init__(self, *, intents: discord.Intents, http_server: Optional[HTTPServer] = None):
         super().__init__(intents=intents)
         self.tree = app_commands.CommandTree(self)
+        self.http_server = http_server
+        self.job_runner = None
+        self.message_updater = MessageUpdater(self, min_interval=PROGRESS_UPDATE_INTERVAL)
 
     async def setup_hook(self):
+        if self.http_server is not None:
+            await self.http_server.start()
+        if self.job_runner is not None:
+            self.job_runner.start()
         if SYNC_GUILD is not None:
             for guild_id in SYNC_GUILD.split(","):
                 guild = discord.Object(id=int(guild_id))
@@ -27,43 +47,60 @@ class DiscordClient(discord.Client):
                 await self.tree.sync(guild=guild)
 
 
-def _expand_template(template: str) -> List[str]:
+def _prompt_cap(img_client: ImageClient) -> int:
+    return min(MAX_PROMPTS, img_client.max_prompts or MAX_PROMPTS)
+
+
+def _validate_request(template: PromptTemplate, count: int, cap: int) -> Optional[str]:
+    if not 1 <= count <= cap:
+        return f"count must be between 1 and {cap}"
+    if template.size > MAX_TEMPLATE_COMBINATIONS:
+        return f"That template expands to {template.size} prompts, the limit is {MAX_TEMPLATE_COMBINATIONS}"
+    return None
+
+
+def _title(title: str, template: PromptTemplate, page_size: int) -> str:
+    if template.size > page_size:
+        title += f" ({template.size} combinations, {page_size} per run)"
+    return title
+
+
+class GenerationView(discord.ui.View):
     """
-    a {photo, painting} of a {dog, cat}
+    Shared Start/🔄 flow, progressively editing the embed with partial grids as they arrive.
+
+    Templates with more combinations than fit in one run are paged through, one page per press. Each run is a
+    durable job that waits for its turn in the shared FairScheduler, showing its queue position on the button
+    meanwhile. Draft runs add a select to upscale one of their images, which is posted as a new message.
     """
-    match = re.search(r"\{([^}]+)\}", template)
-    if not match:
-        return [template]
-    options = match.group(1).split(", ")
-    expanded = []
-    for option in options:
-        expanded += _expand_template(template[: match.start()] + option + template[match.end() :])
-    return expanded
 
+    kind = "txt2img"
 
-class ImagineView(discord.ui.View):
     def __init__(
         self,
         prompt: str,
         user: discord.User,
         img_client: ImageClient,
+        job_runner: JobRunner,
         count: int,
-        negative_prompt: str,
-        seed: Optional[int] = 0,
+        seed: int,
     ):
         super().__init__(timeout=None)
         self.prompt = prompt
         self.user = user
         self.img_client = img_client
+        self.job_runner = job_runner
         self.seed = seed
-        self.negative_prompt = negative_prompt
         self.count = count
+        self.template = PromptTemplate(prompt)
+        self.page = 0
+        self.page_size = max(1, _prompt_cap(img_client) // count)
 
-        self.title = f"> {prompt}"
         self.image_emb = discord.Embed()
-        self.image_emb.set_image(url=BLANK_IMAGE)
         self.generate_image_task = None
         self.button = None
+        self.upscale_select = None
+        self.upscale_tasks = set()
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         return interaction.user == self.user
@@ -77,91 +114,290 @@ class ImagineView(discord.ui.View):
 
         self.generate_image_task = asyncio.create_task(self.generate_image(interaction))
 
+    def job_request(self, prompts: List[str]) -> Dict:
+        """
+        The kind specific JobRunner.submit arguments, i.e. hparams and for img2img the image_url.
+        """
+        raise NotImplementedError()
+
+    def request_options(self) -> Dict:
+        return {}
+
+    def _log_request(self, interaction: discord.Interaction):
+        record = {
+            "t": time.time(),
+            "user": self.user.id,
+            "guild": interaction.guild_id,
+            "kind": self.kind,
+            "prompt": self.prompt,
+            "count": self.count,
+            "seed": self.seed,
+            "page": self.page,
+            **self.request_options(),
+        }
+        with open(REQUEST_LOG, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def set_upscale_options(self, prompts: List[str], seed: int, hparams: Dict, draft_id: Optional[str]):
+        if self.upscale_select is not None:
+            self.remove_item(self.upscale_select)
+            self.upscale_select = None
+        if hparams.get("draft"):
+            self.upscale_select = _UpscaleSelect(self, prompts, seed, hparams, draft_id)
+            self.add_item(self.upscale_select)
+
+    async def upscale(
+        self,
+        interaction: discord.Interaction,
+        prompt: str,
+        seed: int,
+        hparams: Dict,
+        draft_id: Optional[str],
+        index: int,
+    ):
+        embed = discord.Embed()
+        embed.set_image(url=BLANK_IMAGE)
+        content = f"> {prompt} (upscaling #{index + 1})"
+        await interaction.response.send_message(content, embed=embed)
+        message = await interaction.original_response()
+        target = MessageTarget(message.channel.id, message.id, interaction, content)
+        try:
+            await self.job_runner.submit(
+                _MessageListener(interaction.client, message.channel.id, message.id, target),
+                "upscale",
+                [prompt],
+                seed,
+                hparams,
+                user_id=self.user.id,
+                guild_id=interaction.guild_id,
+                channel_id=message.channel.id,
+                message_id=message.id,
+                draft_id=draft_id,
+                index=index,
+            )
+        except Exception as e:
+            logging.error(f"Upscale failed: {e!r}")
+            embed.set_image(url=ERROR_IMAGE)
+            await interaction.client.message_updater.update(target, final=True, embed=embed)
+
     async def generate_image(self, interaction: discord.Interaction):
-        prompts = _expand_template(self.prompt)
-        logging.info(f"Generating images for {prompts}")
-        img_link = await self.img_client.generate_images(
-            prompts * self.count, self.seed, {"negative_prompt": self.negative_prompt}
+        prompts = self.template.page(self.page, self.page_size) * self.count
+        if REQUEST_LOG is not None:
+            self._log_request(interaction)
+        request = self.job_request(prompts)
+        try:
+            await self.job_runner.submit(
+                _ViewListener(self, interaction, prompts, self.seed, request["hparams"]),
+                self.kind,
+                prompts,
+                self.seed,
+                user_id=self.user.id,
+                guild_id=interaction.guild_id,
+                channel_id=interaction.channel_id,
+                message_id=interaction.message.id,
+                **request,
+            )
+        except Exception as e:
+            logging.error(f"Generation failed: {e!r}")
+            self.image_emb.set_image(url=ERROR_IMAGE)
+            self.button.disabled = False
+            self.button.label = "🔄"
+            await interaction.client.message_updater.update(
+                _view_target(interaction), final=True, embed=self.image_emb, view=self
+            )
+
+
+class _UpscaleSelect(discord.ui.Select):
+    def __init__(self, view: GenerationView, prompts: List[str], seed: int, hparams: Dict, draft_id: Optional[str]):
+        # Discord allows at most 25 options
+        options = [
+            discord.SelectOption(label=f"#{i + 1} {prompt}"[:100], value=str(i))
+            for i, prompt in enumerate(prompts[:25])
+        ]
+        super().__init__(placeholder="Upscale...", options=options)
+        self.generation_view = view
+        self.prompts = prompts
+        self.seed = seed
+        self.hparams = hparams
+        self.draft_id = draft_id
+
+    async def callback(self, interaction: discord.Interaction):
+        index = int(self.values[0])
+        task = asyncio.create_task(
+            self.generation_view.upscale(
+                interaction, self.prompts[index], self.seed, self.hparams, self.draft_id, index
+            )
         )
-        self.image_emb.set_image(url=img_link)
-        self.seed = hash(time.time())
-        self.button.disabled = False
-        self.button.label = "🔄"
-        await interaction.message.edit(embed=self.image_emb, view=self)
+        self.generation_view.upscale_tasks.add(task)
+        task.add_done_callback(self.generation_view.upscale_tasks.discard)
+
+
+def _view_target(interaction: discord.Interaction) -> MessageTarget:
+    return MessageTarget(interaction.channel_id, interaction.message.id, interaction, interaction.message.content)
+
+
+class _ViewListener(JobListener):
+    """
+    Edits a live view's message as its job moves through the queue. Queue positions and partial grids are
+    handed to the MessageUpdater without waiting, so they never hold up the job and stale ones are dropped.
+    """
+
+    def __init__(
+        self, view: GenerationView, interaction: discord.Interaction, prompts: List[str], seed: int, hparams: Dict
+    ):
+        self.view = view
+        self.interaction = interaction
+        self.prompts = prompts
+        self.seed = seed
+        self.hparams = hparams
+        self.target = _view_target(interaction)
+        self.updater = interaction.client.message_updater
+
+    async def on_position(self, position: int):
+        self.view.button.label = f"Queued (#{position})"
+        self.updater.update(self.target, view=self.view)
+
+    async def on_progress(self, progress: ImageProgress):
+        view = self.view
+        view.image_emb.set_image(url=progress.link)
+        if progress.final:
+            if progress.full_link is not None:
+                view.image_emb.description = f"[Full resolution]({progress.full_link})"
+            view.set_upscale_options(self.prompts, self.seed, self.hparams, progress.draft_id)
+            view.seed = hash(time.time())
+            view.page += 1
+            view.button.disabled = False
+            view.button.label = "🔄"
+        else:
+            view.button.label = f"Loading... {progress.done}/{progress.total}"
+        update = self.updater.update(self.target, final=progress.final, embed=view.image_emb, view=view)
+        if progress.final:
+            with metrics.span("discord_edit"):
+                await update
+
+
+class _MessageListener(JobListener):
+    """
+    Edits a message without a live view with the final result, i.e. upscales and jobs that were queued before a
+    restart. For the latter the view is gone, so the result replaces the stale button.
+    """
+
+    def __init__(
+        self,
+        client: discord.Client,
+        channel_id: Optional[int],
+        message_id: Optional[int],
+        target: Optional[MessageTarget] = None,
+    ):
+        self.client = client
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.target = target
+        if target is None and channel_id is not None and message_id is not None:
+            self.target = MessageTarget(channel_id, message_id)
+
+    async def on_progress(self, progress: ImageProgress):
+        if not progress.final or self.target is None:
+            return
+        embed = discord.Embed()
+        embed.set_image(url=progress.link)
+        if progress.full_link is not None:
+            embed.description = f"[Full resolution]({progress.full_link})"
+        with metrics.span("discord_edit"):
+            await self.client.message_updater.update(self.target, final=True, embed=embed, view=None)
 
 
-class EnhanceView(discord.ui.View):
+class ImagineView(GenerationView):
+    def __init__(
+        self,
+        prompt: str,
+        user: discord.User,
+        img_client: ImageClient,
+        job_runner: JobRunner,
+        count: int,
+        negative_prompt: str,
+        seed: Optional[int] = 0,
+        draft: Optional[bool] = False,
+    ):
+        super().__init__(prompt, user, img_client, job_runner, count, seed)
+        self.negative_prompt = negative_prompt
+        self.draft = draft
+
+        self.title = _title(f"> {prompt}", self.template, self.page_size)
+        self.image_emb.set_image(url=BLANK_IMAGE)
+
+    def request_options(self) -> Dict:
+        return {"negative_prompt": self.negative_prompt, "draft": self.draft}
+
+    def job_request(self, prompts: List[str]) -> Dict:
+        logging.info(f"Generating images for {prompts}")
+        hparams = {"negative_prompt": self.negative_prompt}
+        if self.draft:
+            hparams["draft"] = True
+        return {"hparams": hparams}
+
+
+class EnhanceView(GenerationView):
+    kind = "img2img"
+
     def __init__(
         self,
         prompt: str,
         image_url: str,
         user: discord.User,
         img_client: ImageClient,
+        job_runner: JobRunner,
         count: int,
         seed: int,
         strength: int,
     ):
-        super().__init__(timeout=None)
-        self.prompt = prompt
+        super().__init__(prompt, user, img_client, job_runner, count, seed)
         self.image_url = image_url
-        self.user = user
-        self.img_client = img_client
-        self.seed = seed
         self.strength = strength
-        self.count = count
 
-        self.title = f"> {prompt} on {image_url}"
-        self.image_emb = discord.Embed()
+        self.title = _title(f"> {prompt} on {image_url}", self.template, self.page_size)
         self.image_emb.set_image(url=self.image_url)
-        self.generate_image_task = None
-        self.button = None
 
-    async def interaction_check(self, interaction: discord.Interaction) -> bool:
-        return interaction.user == self.user
+    def request_options(self) -> Dict:
+        return {"image_url": self.image_url, "strength": self.strength}
 
-    @discord.ui.button(label="Start", custom_id="start", style=discord.ButtonStyle.primary)
-    async def on_start(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.button = button
-        self.button.disabled = True
-        self.button.label = "Loading..."
-        await interaction.response.edit_message(view=self)
-
-        self.generate_image_task = asyncio.create_task(self.generate_image(interaction))
-
-    async def generate_image(self, interaction: discord.Interaction):
-        prompts = _expand_template(self.prompt)
+    def job_request(self, prompts: List[str]) -> Dict:
         logging.info(f"Generating image for {prompts} on {self.image_url}")
-        img_link = await self.img_client.generate_images_from_image(
-            prompts * self.count, self.image_url, self.seed, {"strength": self.strength / 100}
-        )
-        self.image_emb.set_image(url=img_link)
-        self.seed = hash(time.time())
-        self.button.disabled = False
-        self.button.label = "🔄"
-        await interaction.message.edit(embed=self.image_emb, view=self)
+        return {"image_url": self.image_url, "hparams": {"strength": self.strength / 100}}
 
 
-def update_discord_client(client: discord.Client, img_client: ImageClient):
+def update_discord_client(client: discord.Client, img_client: ImageClient, job_runner: JobRunner):
     @client.event
     async def on_ready():
         logging.info(f"We have logged in as {client.user}")
 
     @client.tree.command()
-    @app_commands.describe(prompt="Caption to generate an image for", seed="Random seed for image generation")
+    @app_commands.describe(
+        prompt="Caption to generate an image for",
+        seed="Random seed for image generation",
+        draft="Fast low resolution preview, pick images to upscale afterwards",
+    )
     async def imagine(
         interaction: discord.Interaction,
         prompt: str,
         seed: Optional[int] = 0,
         count: Optional[int] = 1,
         negative_prompt: Optional[str] = "disfigured, ugly, deformed",
+        draft: Optional[bool] = False,
     ):
+        error = _validate_request(PromptTemplate(prompt), count, _prompt_cap(img_client))
+        if error is not None:
+            await interaction.response.send_message(error, ephemeral=True)
+            return
         view = ImagineView(
             prompt=prompt,
             user=interaction.user,
             img_client=img_client,
+            job_runner=job_runner,
             seed=seed,
             count=count,
             negative_prompt=negative_prompt,
+            draft=draft,
         )
         await interaction.response.send_message(view.title, embed=view.image_emb, view=view)
 
@@ -180,21 +416,40 @@ def update_discord_client(client: discord.Client, img_client: ImageClient):
         seed: Optional[int] = 0,
         count: Optional[int] = 1,
     ):
+        error = _validate_request(PromptTemplate(prompt), count, _prompt_cap(img_client))
+        if not img_client.supports_img2img:
+            error = "This bot's backend doesn't support /enhance"
+        if error is not None:
+            await interaction.response.send_message(error, ephemeral=True)
+            return
         view = EnhanceView(
             prompt=prompt,
             image_url=image_url,
             strength=strength,
             user=interaction.user,
             img_client=img_client,
+            job_runner=job_runner,
             seed=seed,
             count=count,
         )
         await interaction.response.send_message(view.title, embed=view.image_emb, view=view)
 
 
-def create_discord_client(img_client: ImageClient) -> discord.Client:
+def create_discord_client(
+    img_client: ImageClient,
+    http_server: Optional[HTTPServer] = None,
+    scheduler: Optional[FairScheduler] = None,
+    job_queue: Optional[JobQueue] = None,
+) -> discord.Client:
     intents = discord.Intents.default()
     intents.message_content = True
-    client = DiscordClient(intents=intents)
-    update_discord_client(client, img_client)
+    scheduler = scheduler or FairScheduler(max_concurrent=MAX_CONCURRENT_JOBS, max_per_user=MAX_JOBS_PER_USER)
+    client = DiscordClient(intents=intents, http_server=http_server)
+    client.job_runner = JobRunner(
+        job_queue or JobQueue(),
+        img_client,
+        scheduler,
+        resume_listener=lambda job: _MessageListener(client, job.channel_id, job.message_id),
+    )
+    update_discord_client(client, img_client, client.job_runner)
     return client
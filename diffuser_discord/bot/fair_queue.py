@@ -0,0 +1,149 @@
+from typing import Optional, Dict, List, Callable, Awaitable, AsyncIterator, Tuple
+from contextlib import asynccontextmanager
+import itertools
+import logging
+import asyncio
+
+
+class _Job:
+    def __init__(
+        self,
+        seq: int,
+        user_id: int,
+        guild_id: Optional[int],
+        cost: float,
+        start_tag: float,
+        finish_tag: float,
+        on_position: Optional[Callable[[int], Awaitable]],
+    ):
+        self.seq = seq
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.cost = cost
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.on_position = on_position
+        self.position = None
+        self.ready = asyncio.get_running_loop().create_future()
+
+
+class FairScheduler:
+    """
+    Two-level weighted fair queue shared by all views, so one user (or guild) queueing many expensive jobs
+    can't starve everyone else.
+
+    Guilds are served in order of the weighted cost they've already received, and within a guild each user's
+    jobs get virtual finish tags advancing by cost / weight, smallest tag first. A global and a per-user
+    concurrency limit bound how many jobs run at once.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: Optional[int] = 2,
+        max_per_user: Optional[int] = 1,
+        user_weights: Optional[Dict[int, float]] = None,
+        guild_weights: Optional[Dict[int, float]] = None,
+        img2img_cost: Optional[float] = 2.0,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.user_weights = user_weights or {}
+        self.guild_weights = guild_weights or {}
+        self.img2img_cost = img2img_cost
+        self.waiting: List[_Job] = []
+        self.active = 0
+        self.active_by_user: Dict[int, int] = {}
+        self.virtual_time = 0.0
+        self.user_finish: Dict[int, float] = {}
+        self.guild_time = 0.0
+        self.guild_finish: Dict[Optional[int], float] = {}
+        self.seq = itertools.count()
+
+    def estimate_cost(self, num_prompts: int, kind: str) -> float:
+        return num_prompts * (self.img2img_cost if kind == "img2img" else 1.0)
+
+    def stats(self) -> Dict:
+        return {"waiting": len(self.waiting), "active": self.active}
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        user_id: int,
+        guild_id: Optional[int],
+        cost: float,
+        on_position: Optional[Callable[[int], Awaitable]] = None,
+    ) -> AsyncIterator[None]:
+        """
+        Waits for this job's turn, calling `on_position(n)` whenever its place in the queue changes.
+        """
+        start_tag = max(self.virtual_time, self.user_finish.get(user_id, 0.0))
+        self.user_finish[user_id] = start_tag + cost / self.user_weights.get(user_id, 1.0)
+        job = _Job(next(self.seq), user_id, guild_id, cost, start_tag, self.user_finish[user_id], on_position)
+        self.waiting.append(job)
+        self._dispatch()
+        try:
+            await job.ready
+        except asyncio.CancelledError:
+            if job in self.waiting:
+                self.waiting.remove(job)
+                self._dispatch()
+            else:
+                self._release(job)
+            raise
+        try:
+            yield
+        finally:
+            self._release(job)
+
+    def _pick(self, jobs: List[_Job], guild_finish: Dict[Optional[int], float], guild_time: float) -> _Job:
+        guild_id = min(
+            {job.guild_id for job in jobs},
+            key=lambda guild_id: (max(guild_finish.get(guild_id, 0.0), guild_time), str(guild_id)),
+        )
+        return min((job for job in jobs if job.guild_id == guild_id), key=lambda job: (job.finish_tag, job.seq))
+
+    def _charge_guild(
+        self, job: _Job, guild_finish: Dict[Optional[int], float], guild_time: float
+    ) -> Tuple[Dict[Optional[int], float], float]:
+        guild_start = max(guild_finish.get(job.guild_id, 0.0), guild_time)
+        guild_finish[job.guild_id] = guild_start + job.cost / self.guild_weights.get(job.guild_id, 1.0)
+        return guild_finish, guild_start
+
+    def _release(self, job: _Job):
+        self.active -= 1
+        self.active_by_user[job.user_id] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.active < self.max_concurrent:
+            runnable = [job for job in self.waiting if self.active_by_user.get(job.user_id, 0) < self.max_per_user]
+            if not runnable:
+                break
+            job = self._pick(runnable, self.guild_finish, self.guild_time)
+            self.guild_finish, self.guild_time = self._charge_guild(job, self.guild_finish, self.guild_time)
+            self.waiting.remove(job)
+            self.virtual_time = max(self.virtual_time, job.start_tag)
+            self.active += 1
+            self.active_by_user[job.user_id] = self.active_by_user.get(job.user_id, 0) + 1
+            job.ready.set_result(None)
+        self._notify_positions()
+
+    def _notify_positions(self):
+        # replay the picking order on a copy of the guild state to estimate each job's place
+        waiting = list(self.waiting)
+        guild_finish, guild_time = dict(self.guild_finish), self.guild_time
+        position = 0
+        while waiting:
+            job = self._pick(waiting, guild_finish, guild_time)
+            guild_finish, guild_time = self._charge_guild(job, guild_finish, guild_time)
+            waiting.remove(job)
+            position += 1
+            if job.position != position and job.on_position is not None:
+                job.position = position
+                task = asyncio.create_task(job.on_position(position))
+                task.add_done_callback(_log_task_error)
+
+
+def _log_task_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(task.exception())
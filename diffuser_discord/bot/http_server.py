@@ -0,0 +1,39 @@
+from typing import Optional
+import logging
+
+from aiohttp import web
+
+from diffuser_discord.bot import metrics
+
+
+class HTTPServer:
+    """
+    Small aiohttp server run on the bot's event loop, e.g. to serve locally stored outputs.
+    """
+
+    def __init__(self, host: Optional[str] = "0.0.0.0", port: Optional[int] = 8080):
+        self.host = host
+        self.port = port
+        self.app = web.Application()
+        self.runner = None
+
+    def serve_directory(self, prefix: str, root_dir: str):
+        self.app.router.add_static(prefix, root_dir)
+
+    def serve_metrics(self, path: Optional[str] = "/metrics", registry: Optional[metrics.Registry] = None):
+        registry = registry or metrics.REGISTRY
+
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(text=registry.render(), content_type="text/plain")
+
+        self.app.router.add_get(path, handle)
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logging.info(f"HTTP server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
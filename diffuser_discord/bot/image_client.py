@@ -1,20 +1,57 @@
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Callable, Awaitable, NamedTuple, AsyncIterator, Any, Tuple
 from abc import ABC, abstractmethod
-from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import asyncio
 import logging
+import queue
+import os
+import json
+import time
+import uuid
 import modal
 
+from diffuser_discord.bot.image_fetcher import ImageFetcher, FetchError
+from diffuser_discord.bot import metrics
+from diffuser_discord.ml_worker.output_sinks import OutputSink, ImgurSink
+from diffuser_discord.ml_worker import drafts
 
 ERROR_IMAGE = "https://i.imgur.com/CJ7DFk3.png"
 BLANK_IMAGE = "https://i.imgur.com/HdKWBzA.png"
 
 
+class ImageProgress(NamedTuple):
+    link: str
+    done: int
+    total: int
+    full_link: Optional[str] = None
+    # set on the final progress of a draft, identifies its cached intermediates for stream_upscale
+    draft_id: Optional[str] = None
+
+    @property
+    def final(self) -> bool:
+        return self.done >= self.total
+
+
 class ImageClient(ABC):
+    # most prompts a single request may hold, None for no backend limit
+    max_prompts: Optional[int] = None
+    supports_img2img: bool = True
+    # requests the backend works on at once, None when it scales out on demand
+    concurrency: Optional[int] = 1
+
     @abstractmethod
     def init(self):
         pass
 
+    def warmup(self):
+        """
+        Blocks until the backend is ready to serve requests.
+        """
+        pass
+
     @abstractmethod
     async def generate_images(self, prompts: List[str], seed: int, hparams: Dict) -> str:
         pass
@@ -23,93 +60,743 @@ class ImageClient(ABC):
     async def generate_images_from_image(self, prompts: List[str], image_url: str, seed: int, hparams: Dict) -> str:
         pass
 
+    async def stream_images(self, prompts: List[str], seed: int, hparams: Dict) -> AsyncIterator[ImageProgress]:
+        """
+        Yields partial grids as images finish, ending with the complete grid. Defaults to only the final grid.
+        """
+        link = await self.generate_images(prompts, seed, hparams)
+        yield ImageProgress(link, len(prompts), len(prompts))
 
-def _local_init():
-    global deep_floyd
-    from diffuser_discord.ml_worker import deepfloyd_gen
+    async def stream_images_from_image(
+        self, prompts: List[str], image_url: str, seed: int, hparams: Dict
+    ) -> AsyncIterator[ImageProgress]:
+        link = await self.generate_images_from_image(prompts, image_url, seed, hparams)
+        yield ImageProgress(link, len(prompts), len(prompts))
+
+    async def stream_upscale(
+        self, draft_id: Optional[str], index: int, prompt: str, seed: int, hparams: Dict
+    ) -> AsyncIterator[ImageProgress]:
+        """
+        Finishes image `index` of a draft at full quality. Defaults to regenerating it from its prompt and seed,
+        image `index` of a request is always generated from `seed + index`.
+        """
+        async for progress in self.stream_images([prompt], seed + index, drafts.full_quality(hparams)):
+            yield progress
+
+
+class WorkerResult(NamedTuple):
+    grids: List[Optional["np.ndarray"]]
+    stats: Dict
+    # one per grid when the request was a draft
+    draft_ids: Optional[List[str]] = None
+
+
+def _local_init(
+    device: str,
+    backend: str,
+    backend_options: Dict,
+    memory_fraction: Optional[float],
+    pipelined: bool,
+    preview_max_side: Optional[int],
+    memory_profile: Optional[str] = None,
+):
+    global deep_floyd, batch_sizer, pipeline_stages, partial_max_side, worker_device
+    worker_device = device
+    pipeline_stages = pipelined
+    partial_max_side = preview_max_side
+    if device.startswith("cuda:"):
+        # pin before torch initializes CUDA so this process only sees its own card
+        os.environ["CUDA_VISIBLE_DEVICES"] = device.split(":")[1]
+    from diffuser_discord.ml_worker import batch_sizing
+
+    if backend == "fake":
+        from diffuser_discord.ml_worker import fake_gen
+
+        deep_floyd = fake_gen.FakeDeepFloydIF(memory_profile=memory_profile, **backend_options)
+    else:
+        from diffuser_discord.ml_worker import deepfloyd_gen
+        import torch
 
-    deep_floyd = deepfloyd_gen.DeepFloydIF()
+        if memory_fraction is not None:
+            torch.cuda.set_per_process_memory_fraction(memory_fraction)
+        deep_floyd = deepfloyd_gen.DeepFloydIF(output_type="np", memory_profile=memory_profile)
     deep_floyd.load_weights()
+    batch_sizer = batch_sizing.AdaptiveBatchSizer()
 
 
-def _local_generate_images(prompts: List[str], seed: int, batch_size: int, hparams: Dict) -> str:
+def _local_warmup(dummy_generation: bool) -> Dict[str, float]:
     global deep_floyd
-    from diffuser_discord.ml_worker import imgur_utils, image_utils
+    timings = dict(deep_floyd.load_times)
+    if dummy_generation:
+        timings["dummy_generation"] = deep_floyd.warmup()
+    # don't bill the warmup to the first request
+    _worker_stats()
+    return timings
+
+
+def _worker_stats() -> Dict:
+    """
+    Stage timings and the GPU high-water mark since the previous call, i.e. for the job that just ran.
+    """
+    global deep_floyd, worker_device
+    return {"spans": deep_floyd.timer.pop(), "gpu_peak_bytes": deep_floyd.pop_peak_memory(), "device": worker_device}
+
+
+def _report_progress(
+    img_list: List, prev_count: int, prompt_groups: List[List[str]], progress_queues: List[Optional[Any]]
+):
+    """
+    Pushes a partial grid (laid out like the final grid, downscaled to preview size) to each incomplete request
+    that got new images.
+    """
+    global partial_max_side
+    from diffuser_discord.ml_worker import image_utils
+
+    start = 0
+    for group, progress_queue in zip(prompt_groups, progress_queues):
+        done = min(max(len(img_list) - start, 0), len(group))
+        if progress_queue is not None and 0 < done < len(group) and start + done > prev_count:
+            grid = image_utils.array_grid(img_list[start : start + done], shape=image_utils._get_grid_shape(len(group)))
+            if partial_max_side is not None:
+                grid = image_utils.thumbnail(grid, partial_max_side)
+            progress_queue.put((done, grid))
+        start += len(group)
+
+
+def _run_pipelined(
+    prompts: List[str],
+    image_seeds: List[int],
+    group_sizes: List[int],
+    batch_size: int,
+    hparams: Dict,
+    report: Callable[[List, int], None],
+    draft_keys: Optional[List[str]] = None,
+) -> Optional[List]:
+    """
+    Runs the chunks through the stage-parallel pipeline, returning None after an OOM so the caller can fall back
+    to the sequential, adaptively sized loop.
+
+    Chunks never span requests, so in a coalesced batch request n+1's stage_1 overlaps request n's later stages
+    instead of the whole batch going through as one chunk.
+    """
+    global deep_floyd, batch_sizer
+    from diffuser_discord.ml_worker import batch_sizing
+
+    size = batch_sizer.get("txt2img", batch_size)
+    offsets = []
+    start = 0
+    for group_size in group_sizes:
+        offsets.extend(range(start, start + group_size, size))
+        start += group_size
+    ends = offsets[1:] + [len(prompts)]
+    chunks = [(prompts[i:end], image_seeds[i:end]) for i, end in zip(offsets, ends)]
+    chunk_keys = [draft_keys[i:end] for i, end in zip(offsets, ends)] if draft_keys else None
+    img_list = []
+    try:
+        for i, images in zip(offsets, deep_floyd.generate_images_pipelined(chunks, hparams, draft_keys=chunk_keys)):
+            report(images, i)
+            img_list.extend(images)
+    except Exception as e:
+        if not batch_sizing.is_oom_error(e):
+            raise
+        batch_sizer.record_oom("txt2img", max(len(chunk_prompts) for chunk_prompts, _ in chunks))
+        deep_floyd.release_memory()
+        return None
+    return img_list
+
+
+def _local_generate_image_batches(
+    prompt_groups: List[List[str]],
+    seeds: List[int],
+    batch_size: int,
+    hparams: Dict,
+    progress_queues: Optional[List[Optional[Any]]] = None,
+) -> WorkerResult:
+    """
+    Runs the prompts of several requests through the pipeline together and returns one uint8 grid per request,
+    leaving encoding to the bot process.
+
+    Image j of a request is generated from seed + j whichever chunk it lands in, so coalescing and batch sizes
+    don't change results. Drafts get a draft id per request, their images' intermediates are cached in this
+    worker as "<draft id>:<index>".
+    """
+    global deep_floyd, batch_sizer
+    from diffuser_discord.ml_worker import image_utils, batch_sizing
+
+    prompts = [prompt for group in prompt_groups for prompt in group]
+    image_seeds = [seed + j for seed, group in zip(seeds, prompt_groups) for j in range(len(group))]
+    progress_queues = progress_queues or [None] * len(prompt_groups)
+    finished = []
+    draft_ids = None
+    draft_keys = None
+    if drafts.last_stage(hparams) != "stage_3":
+        draft_ids = [uuid.uuid4().hex for _ in prompt_groups]
+        draft_keys = [f"{draft_id}:{i}" for draft_id, group in zip(draft_ids, prompt_groups) for i in range(len(group))]
+
+    def report(images: List, i: int):
+        finished.extend(images)
+        _report_progress(finished, i, prompt_groups, progress_queues)
+
+    def generate_chunk(prompt_chunk: List[str], i: int) -> List:
+        chunk_keys = draft_keys[i : i + len(prompt_chunk)] if draft_keys else None
+        images = deep_floyd.generate_images(
+            prompt_chunk, seeds=image_seeds[i : i + len(prompt_chunk)], hparams=hparams, draft_keys=chunk_keys
+        )
+        report(images, i)
+        return images
 
     try:
-        img_list = []
-        for i in range(0, len(prompts), batch_size):
-            prompt_chunk = prompts[i : i + batch_size]
-            img_list.extend(deep_floyd.generate_images(prompt_chunk, seed=seed + i, hparams=hparams))
-        img = image_utils.image_grid(img_list)
-        return imgur_utils.upload_to_imgur(img)
+        img_list = None
+        if pipeline_stages:
+            group_sizes = [len(group) for group in prompt_groups]
+            img_list = _run_pipelined(prompts, image_seeds, group_sizes, batch_size, hparams, report, draft_keys)
+        if img_list is None:
+            finished.clear()
+            img_list = batch_sizing.run_chunked(
+                generate_chunk,
+                prompts,
+                batch_sizer,
+                "txt2img",
+                batch_size,
+                on_oom=deep_floyd.release_memory,
+            )
+        grids = []
+        start = 0
+        with deep_floyd.timer.time("grid"):
+            for group in prompt_groups:
+                grids.append(image_utils.array_grid(img_list[start : start + len(group)]))
+                start += len(group)
+        return WorkerResult(grids, _worker_stats(), draft_ids)
     except Exception as e:
         logging.error(e)
-    return ERROR_IMAGE
+    return WorkerResult([None] * len(prompt_groups), _worker_stats())
+
+
+def _local_generate_images(
+    prompts: List[str], seed: int, batch_size: int, hparams: Dict, progress_queue: Optional[Any] = None
+) -> WorkerResult:
+    return _local_generate_image_batches([prompts], [seed], batch_size, hparams, [progress_queue])
 
 
 def _local_generate_images_from_image(
-    prompts: List[str], image_url: str, seed: int, batch_size: int, hparams: Dict
-) -> str:
-    global deep_floyd
-    from diffuser_discord.ml_worker import imgur_utils, image_utils
+    prompts: List[str],
+    source_image: "np.ndarray",
+    seed: int,
+    batch_size: int,
+    hparams: Dict,
+    progress_queue: Optional[Any] = None,
+) -> WorkerResult:
+    """
+    Runs img2img on a source image the bot already downloaded and resized, so no network I/O happens here.
+    """
+    global deep_floyd, batch_sizer
+    from diffuser_discord.ml_worker import image_utils, batch_sizing
+    from PIL import Image
 
-    original_image = image_utils.image_from_url(image_url)
-    original_image = original_image.resize((512, 512))
+    original_image = Image.fromarray(source_image)
+    finished = []
+
+    def generate_chunk(prompt_chunk: List[str], i: int) -> List:
+        images = deep_floyd.generate_images_from_image(
+            prompt_chunk,
+            [original_image] * len(prompt_chunk),
+            seeds=[seed + i + j for j in range(len(prompt_chunk))],
+            hparams=hparams,
+        )
+        finished.extend(images)
+        _report_progress(finished, i, [prompts], [progress_queue])
+        return images
 
     try:
-        img_list = []
-        for i in range(0, len(prompts), batch_size):
-            prompt_chunk = prompts[i : i + batch_size]
-            img_list.extend(
-                deep_floyd.generate_images_from_image(
-                    prompt_chunk, [original_image] * len(prompt_chunk), seed=seed + i, hparams=hparams
-                )
-            )
-            # HACK: Handle OOM from img2img
-            deep_floyd.reload_weights()
-        img = image_utils.image_grid(img_list)
-        return imgur_utils.upload_to_imgur(img)
+        img_list = batch_sizing.run_chunked(
+            generate_chunk,
+            prompts,
+            batch_sizer,
+            "img2img",
+            batch_size,
+            on_oom=deep_floyd.reload_weights,
+        )
+        with deep_floyd.timer.time("grid"):
+            grid = image_utils.array_grid(img_list)
+        return WorkerResult([grid], _worker_stats())
     except Exception as e:
         logging.error(e)
-    return ERROR_IMAGE
+    return WorkerResult([None], _worker_stats())
+
+
+def _local_upscale(key: str) -> WorkerResult:
+    """
+    Runs the remaining stages on one cached draft image. Raises KeyError if this worker no longer has it.
+    """
+    global deep_floyd
+    from diffuser_discord.ml_worker import image_utils
+
+    try:
+        images = deep_floyd.upscale(key)
+        with deep_floyd.timer.time("grid"):
+            grid = image_utils.array_grid(images)
+        return WorkerResult([grid], _worker_stats())
+    except KeyError:
+        _worker_stats()
+        raise
+    except Exception as e:
+        logging.error(e)
+    return WorkerResult([None], _worker_stats())
+
+
+class _PendingRequest(NamedTuple):
+    prompts: List[str]
+    seed: int
+    hparams: Dict
+    future: asyncio.Future
+    progress_queue: Optional[Any]
+
+
+def _hparams_key(hparams: Dict) -> str:
+    return json.dumps(hparams, sort_keys=True, default=str)
+
+
+class BatchScheduler:
+    """
+    Coalesces concurrent requests with identical hparams into a single worker call.
+
+    A batch is flushed once it holds `max_batch_size` prompts or `max_wait` seconds after its first request arrived.
+    Every request keeps its own seed, image j being generated from seed + j, so what it is batched with never
+    changes its images.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[List[str]], List[int], Dict, List[Optional[Any]]], Awaitable[List[Any]]],
+        max_batch_size: int,
+        max_wait: float,
+    ) -> None:
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending: Dict[str, List[_PendingRequest]] = {}
+        self.flush_tasks: Dict[str, asyncio.Task] = {}
+
+    async def submit(self, prompts: List[str], seed: int, hparams: Dict, progress_queue: Optional[Any] = None) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        key = _hparams_key(hparams)
+        queue = self.pending.setdefault(key, [])
+        queue.append(_PendingRequest(prompts, seed, hparams, future, progress_queue))
+        if sum(len(req.prompts) for req in queue) >= self.max_batch_size:
+            self._flush(key)
+        elif key not in self.flush_tasks:
+            self.flush_tasks[key] = asyncio.create_task(self._flush_later(key))
+        return await future
+
+    async def _flush_later(self, key: str):
+        await asyncio.sleep(self.max_wait)
+        self.flush_tasks.pop(key, None)
+        self._flush(key)
+
+    def _flush(self, key: str):
+        flush_task = self.flush_tasks.pop(key, None)
+        if flush_task is not None:
+            flush_task.cancel()
+        queue = self.pending.pop(key, [])
+        while queue:
+            batch = [queue.pop(0)]
+            size = len(batch[0].prompts)
+            while queue and size + len(queue[0].prompts) <= self.max_batch_size:
+                size += len(queue[0].prompts)
+                batch.append(queue.pop(0))
+            asyncio.create_task(self._run(batch))
+
+    async def _run(self, batch: List[_PendingRequest]):
+        if len(batch) > 1:
+            logging.info(f"Coalesced {len(batch)} requests into one batch")
+        try:
+            results = await self.run_batch(
+                [req.prompts for req in batch],
+                [req.seed for req in batch],
+                batch[0].hparams,
+                [req.progress_queue for req in batch],
+            )
+        except (Exception, asyncio.CancelledError) as e:
+            # a cancelled worker call still has to resolve every request waiting on it
+            error = e if isinstance(e, Exception) else RuntimeError("Batch was cancelled")
+            for req in batch:
+                if not req.future.done():
+                    req.future.set_exception(error)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+        for req, result in zip(batch, results):
+            if not req.future.done():
+                req.future.set_result(result)
+
+
+class _Worker:
+    """
+    A single-process pool pinned to one device, plus the bookkeeping the dispatcher routes on.
+    """
+
+    def __init__(self, index: int, device: str, executor: ProcessPoolExecutor, warmup_future: Future):
+        self.index = index
+        self.device = device
+        self.executor = executor
+        self.warmup_future = warmup_future
+        self.in_flight = 0
+        self.failures = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.warmup_future.done() and self.warmup_future.exception() is None
+
+    def __repr__(self) -> str:
+        return f"Worker({self.index}, {self.device}, in_flight={self.in_flight}, failures={self.failures})"
+
+
+def _is_failure(result: WorkerResult) -> bool:
+    return all(grid is None for grid in result.grids)
 
 
 class LocalGPUClient(ImageClient):
+    """
+    Runs generation in worker processes, `workers_per_device` per entry of `devices`.
+
+    Each job goes to the healthy worker with the fewest jobs in flight. A worker that crashes, or fails
+    `max_failures` jobs in a row, is replaced (by the warm standby if one is on the same device).
+    Use `backend="fake"` with `devices=["cpu", ...]` to exercise this without GPUs, `backend_options` are passed
+    to FakeDeepFloydIF to set its simulated stage costs and memory. With `pipeline_stages` the
+    requests of a coalesced batch (and chunks of a large request) overlap across DeepFloyd stages instead of running
+    one after another. Overlap stays within one worker call, requests that aren't coalesced still run through all
+    stages in turn.
+    `full_resolution` saves a full resolution grid next to the preview of each final result. It defaults to on
+    except for metered sinks like Imgur, where every request would otherwise cost two uploads.
+    `memory_profile` picks how workers place the models (see memory_profiles.PROFILES), "auto" lets each worker
+    pick the fastest one its card fits.
+    """
+
     def __init__(
-        self, max_batch_size: Optional[int] = 4, max_image_batch_size: Optional[int] = 4, max_workers: Optional[int] = 1
+        self,
+        max_batch_size: Optional[int] = 4,
+        max_image_batch_size: Optional[int] = 4,
+        batch_wait: Optional[float] = 0.05,
+        output_sink: Optional[OutputSink] = None,
+        warmup_generation: Optional[bool] = False,
+        standby: Optional[bool] = False,
+        devices: Optional[List[str]] = None,
+        workers_per_device: Optional[int] = 1,
+        memory_fraction: Optional[float] = None,
+        memory_profile: Optional[str] = None,
+        backend: Optional[str] = "deepfloyd",
+        backend_options: Optional[Dict] = None,
+        max_failures: Optional[int] = 3,
+        pipeline_stages: Optional[bool] = False,
+        preview_encoding: Optional["EncodeSettings"] = None,
+        full_encoding: Optional["EncodeSettings"] = None,
+        full_resolution: Optional[bool] = None,
+        encode_threads: Optional[int] = 2,
+        progress_threads: Optional[int] = 32,
+        image_fetcher: Optional[ImageFetcher] = None,
+        max_drafts: Optional[int] = 1024,
     ) -> None:
         self.max_batch_size = max_batch_size
         self.max_image_batch_size = max_image_batch_size
-        self.max_workers = max_workers
-        self.executor = None
+        self.batch_wait = batch_wait
+        self.output_sink = output_sink or ImgurSink()
+        self.warmup_generation = warmup_generation
+        self.standby = standby
+        self.devices = devices or ["cuda:0"]
+        self.workers_per_device = workers_per_device
+        self.memory_fraction = memory_fraction
+        self.memory_profile = memory_profile
+        self.backend = backend
+        self.backend_options = backend_options or {}
+        self.max_failures = max_failures
+        self.pipeline_stages = pipeline_stages
+        self.preview_encoding = preview_encoding
+        self.full_encoding = full_encoding
+        self.full_resolution = not self.output_sink.metered if full_resolution is None else full_resolution
+        self.encode_threads = encode_threads
+        self.encode_executor = None
+        self.progress_threads = progress_threads
+        self.progress_executor = None
+        self.image_fetcher = image_fetcher or ImageFetcher()
+        self.max_drafts = max_drafts
+        # draft id -> the worker caching its intermediates
+        self.draft_workers: "OrderedDict[str, _Worker]" = OrderedDict()
+        self.workers: List[_Worker] = []
+        self.standby_worker = None
+        self.scheduler = None
+        self.manager = None
+
+    @property
+    def concurrency(self) -> int:
+        return len(self.workers)
 
     def init(self):
-        self.executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_local_init)
+        from diffuser_discord.ml_worker import image_utils
 
-    async def generate_images(self, prompts: List[str], seed: int, hparams: Dict) -> str:
-        loop = asyncio.get_event_loop()
-        output_link = await loop.run_in_executor(
-            self.executor, _local_generate_images, prompts, seed, self.max_batch_size, hparams
+        self.preview_encoding = self.preview_encoding or image_utils.PREVIEW_ENCODING
+        self.full_encoding = self.full_encoding or image_utils.FULL_ENCODING
+        self.encode_executor = ThreadPoolExecutor(max_workers=self.encode_threads)
+        # blocking progress queue reads get their own threads, in the default pool enough concurrent streams
+        # would starve the uploads and end-of-stream puts they are waiting on
+        self.progress_executor = ThreadPoolExecutor(max_workers=self.progress_threads)
+        for device in self.devices:
+            for _ in range(self.workers_per_device):
+                self.workers.append(self._start_worker(len(self.workers), device))
+        self.manager = multiprocessing.Manager()
+        if self.batch_wait:
+            self.scheduler = BatchScheduler(self._generate_image_batches, self.max_batch_size, self.batch_wait)
+
+    def _start_worker(self, index: int, device: str) -> _Worker:
+        """
+        Spawns a worker and immediately has it load its weights, rather than on the first request.
+        """
+        start = time.time()
+        executor = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_local_init,
+            initargs=(
+                device,
+                self.backend,
+                self.backend_options,
+                self.memory_fraction,
+                self.pipeline_stages,
+                self.preview_encoding.max_side,
+                self.memory_profile,
+            ),
         )
-        return output_link
+        future = executor.submit(_local_warmup, self.warmup_generation)
+        future.add_done_callback(lambda future: _log_warmup(future, device, start))
+        return _Worker(index, device, executor, future)
 
-    async def generate_images_from_image(self, prompts: List[str], image_url: str, seed: int, hparams: Dict) -> str:
+    def warmup(self):
+        start = time.time()
+        for worker in self.workers:
+            worker.warmup_future.result()
+        logging.info(f"{len(self.workers)} local workers ready after {time.time() - start:.1f}s")
+        if self.standby:
+            self.standby_worker = self._start_worker(-1, self.devices[0])
+
+    def _replace_worker(self, worker: _Worker):
+        if self.workers[worker.index] is not worker:
+            return
+        # jobs already queued on the old worker still run there, cancelling them would strand their callers
+        worker.executor.shutdown(wait=False)
+        if self.standby_worker is not None and self.standby_worker.device == worker.device:
+            logging.error(f"{worker} failed, switching to the standby worker")
+            replacement = self.standby_worker
+            replacement.index = worker.index
+            self.standby_worker = self._start_worker(-1, worker.device)
+        else:
+            logging.error(f"{worker} failed, starting a new worker")
+            replacement = self._start_worker(worker.index, worker.device)
+        self.workers[worker.index] = replacement
+
+    def _pick_worker(self) -> _Worker:
+        candidates = [worker for worker in self.workers if worker.healthy] or self.workers
+        return min(candidates, key=lambda worker: (worker.in_flight, worker.index))
+
+    async def _run_on(self, fn: Callable, *args, worker: Optional[_Worker] = None) -> Tuple[Any, _Worker]:
+        """
+        Runs `fn` on `worker`, or the least busy one (retrying once on another if it crashes), and returns the
+        result along with the worker that produced it.
+        """
         loop = asyncio.get_event_loop()
-        output_link = await loop.run_in_executor(
-            self.executor,
-            _local_generate_images_from_image,
-            prompts,
-            image_url,
-            seed,
-            self.max_image_batch_size,
+        for attempt in range(2):
+            target = worker or self._pick_worker()
+            target.in_flight += 1
+            try:
+                result = await loop.run_in_executor(target.executor, fn, *args)
+            except BrokenProcessPool:
+                self._replace_worker(target)
+                if worker is not None:
+                    raise
+                continue
+            finally:
+                target.in_flight -= 1
+            target.failures = target.failures + 1 if _is_failure(result) else 0
+            if target.failures >= self.max_failures:
+                self._replace_worker(target)
+            return result, target
+        raise BrokenProcessPool("Worker crashed twice in a row")
+
+    async def _run_in_worker(self, fn: Callable, *args) -> Any:
+        result, _ = await self._run_on(fn, *args)
+        return result
+
+    def _remember_drafts(self, result: WorkerResult, worker: _Worker):
+        for draft_id in result.draft_ids or []:
+            self.draft_workers[draft_id] = worker
+        while len(self.draft_workers) > self.max_drafts:
+            self.draft_workers.popitem(last=False)
+
+    async def _encode_and_save(self, grid: "np.ndarray", settings: "EncodeSettings") -> str:
+        from diffuser_discord.ml_worker import image_utils
+
+        loop = asyncio.get_event_loop()
+        try:
+            with metrics.span("encode"):
+                image_bytes = await loop.run_in_executor(self.encode_executor, image_utils.encode_image, grid, settings)
+            with metrics.span("upload"):
+                return await loop.run_in_executor(None, self.output_sink.save, image_bytes, settings.extension)
+        except Exception as e:
+            logging.error(e)
+        return ERROR_IMAGE
+
+    async def _publish(self, grid: Optional["np.ndarray"], full: bool = True) -> Tuple[str, Optional[str]]:
+        """
+        Encodes a grid off the GPU worker and saves the embed preview and, for final grids, the full resolution.
+        """
+        if grid is None:
+            return ERROR_IMAGE, None
+        if not full or not self.full_resolution:
+            return await self._encode_and_save(grid, self.preview_encoding), None
+        preview_link, full_link = await asyncio.gather(
+            self._encode_and_save(grid, self.preview_encoding), self._encode_and_save(grid, self.full_encoding)
+        )
+        return preview_link, full_link
+
+    async def _generate_image_batches(
+        self, prompt_groups: List[List[str]], seeds: List[int], hparams: Dict, progress_queues: List[Optional[Any]]
+    ) -> List[Tuple[Optional["np.ndarray"], Dict, Optional[str]]]:
+        result, worker = await self._run_on(
+            _local_generate_image_batches,
+            prompt_groups,
+            seeds,
+            self.max_batch_size,
             hparams,
+            progress_queues,
         )
-        return output_link
+        self._remember_drafts(result, worker)
+        draft_ids = result.draft_ids or [None] * len(result.grids)
+        # each request publishes its own grid so encode/upload time lands in its own trace
+        return [(grid, result.stats, draft_id) for grid, draft_id in zip(result.grids, draft_ids)]
+
+    async def _generate_images(
+        self, prompts: List[str], seed: int, hparams: Dict, progress_queue: Optional[Any] = None
+    ) -> Tuple[str, Optional[str], Optional[str]]:
+        with metrics.span("worker"):
+            if self.scheduler is not None:
+                grid, stats, draft_id = await self.scheduler.submit(prompts, seed, hparams, progress_queue)
+            else:
+                result, worker = await self._run_on(
+                    _local_generate_images, prompts, seed, self.max_batch_size, hparams, progress_queue
+                )
+                self._remember_drafts(result, worker)
+                grid, stats, draft_id = result.grids[0], result.stats, (result.draft_ids or [None])[0]
+        metrics.record_worker_stats(stats)
+        link, full_link = await self._publish(grid)
+        return link, full_link, draft_id
+
+    async def _generate_images_from_image(
+        self, prompts: List[str], image_url: str, seed: int, hparams: Dict, progress_queue: Optional[Any] = None
+    ) -> Tuple[str, Optional[str], Optional[str]]:
+        try:
+            with metrics.span("source_fetch"):
+                source_image = await self.image_fetcher.fetch(image_url)
+        except FetchError as e:
+            logging.error(e)
+            return ERROR_IMAGE, None, None
+        logging.info(f"Source image cache {self.image_fetcher.stats()}")
+        with metrics.span("worker"):
+            result = await self._run_in_worker(
+                _local_generate_images_from_image,
+                prompts,
+                source_image,
+                seed,
+                self.max_image_batch_size,
+                hparams,
+                progress_queue,
+            )
+        metrics.record_worker_stats(result.stats)
+        link, full_link = await self._publish(result.grids[0])
+        return link, full_link, None
+
+    async def generate_images(self, prompts: List[str], seed: int, hparams: Dict) -> str:
+        link, _, _ = await self._generate_images(prompts, seed, hparams)
+        return link
+
+    async def generate_images_from_image(self, prompts: List[str], image_url: str, seed: int, hparams: Dict) -> str:
+        link, _, _ = await self._generate_images_from_image(prompts, image_url, seed, hparams)
+        return link
+
+    async def _stream_progress(
+        self, total: int, generate: Callable[[Any], Awaitable[Tuple[str, Optional[str], Optional[str]]]]
+    ) -> AsyncIterator[ImageProgress]:
+        """
+        Runs `generate(progress_queue)` and yields the partial grids the worker pushes, skipping any that were
+        superseded while the previous one was being saved.
+        """
+        loop = asyncio.get_event_loop()
+        progress_queue = self.manager.Queue()
+        task = asyncio.ensure_future(generate(progress_queue))
+        task.add_done_callback(lambda _: loop.run_in_executor(None, progress_queue.put, None))
+        while True:
+            item = await loop.run_in_executor(self.progress_executor, progress_queue.get)
+            while item is not None:
+                try:
+                    item = progress_queue.get_nowait()
+                except queue.Empty:
+                    break
+            if item is None:
+                break
+            done, grid = item
+            link, _ = await self._publish(grid, full=False)
+            yield ImageProgress(link, done, total)
+        link, full_link, draft_id = await task
+        yield ImageProgress(link, total, total, full_link, draft_id)
+
+    async def stream_images(self, prompts: List[str], seed: int, hparams: Dict) -> AsyncIterator[ImageProgress]:
+        async for progress in self._stream_progress(
+            len(prompts), lambda progress_queue: self._generate_images(prompts, seed, hparams, progress_queue)
+        ):
+            yield progress
+
+    async def stream_images_from_image(
+        self, prompts: List[str], image_url: str, seed: int, hparams: Dict
+    ) -> AsyncIterator[ImageProgress]:
+        async for progress in self._stream_progress(
+            len(prompts),
+            lambda progress_queue: self._generate_images_from_image(prompts, image_url, seed, hparams, progress_queue),
+        ):
+            yield progress
+
+    async def stream_upscale(
+        self, draft_id: Optional[str], index: int, prompt: str, seed: int, hparams: Dict
+    ) -> AsyncIterator[ImageProgress]:
+        """
+        Runs the remaining stages on the worker holding the draft's intermediates, regenerating instead if that
+        worker is gone or has evicted them.
+        """
+        worker = self.draft_workers.get(draft_id)
+        if worker is not None and worker in self.workers:
+            try:
+                with metrics.span("worker"):
+                    result, _ = await self._run_on(_local_upscale, f"{draft_id}:{index}", worker=worker)
+                metrics.record_worker_stats(result.stats)
+                link, full_link = await self._publish(result.grids[0])
+                yield ImageProgress(link, 1, 1, full_link)
+                return
+            except (KeyError, BrokenProcessPool) as e:
+                logging.info(f"Draft {draft_id} unavailable ({e!r}), regenerating")
+        async for progress in super().stream_upscale(draft_id, index, prompt, seed, hparams):
+            yield progress
+
+
+def _log_warmup(future: Future, device: str, start: float):
+    if future.exception() is not None:
+        logging.error(f"Worker on {device} failed to warm up: {future.exception()}")
+    else:
+        logging.info(f"Worker on {device} warm after {time.time() - start:.1f}s, timings {future.result()}")
 
 
 class ModalClient(ImageClient):
     MAX_BATCH_SIZE = 9
+    # base model steps for drafts, which also skip the refiner
+    DRAFT_STEPS = 15
+    max_prompts = MAX_BATCH_SIZE
+    supports_img2img = False
+    concurrency = None
 
     def __init__(self) -> None:
         pass
@@ -121,12 +808,14 @@ class ModalClient(ImageClient):
         # arbitrary cap
         if len(prompts) > ModalClient.MAX_BATCH_SIZE:
             prompts = prompts[: ModalClient.MAX_BATCH_SIZE]
+        draft = hparams.get("draft", False)
         out_url = await self.generate_images_func.remote.aio(
             prompts,
             seed,
-            hparams.get("steps", 50),
+            hparams.get("steps", ModalClient.DRAFT_STEPS if draft else 50),
             hparams.get("high_noise_frac", 0.8),
             hparams.get("negative_prompt", 0.8),
+            refine=not draft,
         )
         return out_url
 
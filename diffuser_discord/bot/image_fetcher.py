@@ -0,0 +1,147 @@
+from typing import Optional, Tuple, NamedTuple, Dict
+from collections import OrderedDict
+import logging
+import asyncio
+import time
+
+import aiohttp
+
+
+class FetchError(Exception):
+    pass
+
+
+class _CachedImage(NamedTuple):
+    image: "np.ndarray"
+    etag: Optional[str]
+    fetched: float
+
+
+class ImageFetcher:
+    """
+    Downloads /enhance source images on the bot's event loop through one pooled session, and keeps the decoded,
+    resized buffers so rerolls of the same image skip both the download and the decode.
+
+    Entries younger than `revalidate_after` seconds are reused as is, older ones are revalidated with their ETag.
+    """
+
+    def __init__(
+        self,
+        size: Optional[Tuple[int, int]] = (512, 512),
+        max_bytes: Optional[int] = 20 * 1024**2,
+        timeout: Optional[float] = 10.0,
+        retries: Optional[int] = 3,
+        backoff: Optional[float] = 0.5,
+        max_entries: Optional[int] = 32,
+        revalidate_after: Optional[float] = 300.0,
+        max_connections: Optional[int] = 8,
+    ):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_entries = max_entries
+        self.revalidate_after = revalidate_after
+        self.max_connections = max_connections
+        self.session = None
+        self.entries: "OrderedDict[str, _CachedImage]" = OrderedDict()
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+        }
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def fetch(self, url: str) -> "np.ndarray":
+        """
+        Returns the image at `url` as a uint8 (H, W, 3) array of `size`, raising FetchError if it can't be loaded.
+        """
+        cached = self.entries.get(url)
+        if cached is not None and time.time() - cached.fetched < self.revalidate_after:
+            self.hits += 1
+            self.entries.move_to_end(url)
+            return cached.image
+        # concurrent rerolls of the same image share one download
+        inflight = self.inflight.get(url)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+        task = asyncio.ensure_future(self._fetch(url, cached))
+        self.inflight[url] = task
+        task.add_done_callback(lambda _: self.inflight.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, url: str, cached: Optional[_CachedImage]) -> "np.ndarray":
+        from diffuser_discord.ml_worker import image_utils
+
+        headers = {}
+        if cached is not None and cached.etag is not None:
+            headers["If-None-Match"] = cached.etag
+        for attempt in range(self.retries):
+            try:
+                result = await self._download(url, headers)
+                break
+            except FetchError:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries - 1:
+                    raise FetchError(f"Could not download {url}: {e!r}")
+                delay = self.backoff * 2**attempt
+                logging.warning(f"Fetching {url} failed ({e!r}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        if result is None:
+            self.revalidated += 1
+            image = cached.image
+            etag = cached.etag
+        else:
+            self.misses += 1
+            data, etag = result
+            loop = asyncio.get_event_loop()
+            try:
+                image = await loop.run_in_executor(None, image_utils.decode_image, data, self.size)
+            except Exception as e:
+                raise FetchError(f"Could not decode {url}: {e!r}")
+        self.entries[url] = _CachedImage(image, etag, time.time())
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return image
+
+    async def _download(self, url: str, headers: Dict) -> Optional[Tuple[bytes, Optional[str]]]:
+        """
+        Returns the body and ETag, or None if the server says our cached copy is still current.
+        """
+        async with self._get_session().get(url, headers=headers) as resp:
+            if resp.status == 304:
+                return None
+            if 400 <= resp.status < 500:
+                raise FetchError(f"Could not download {url}: HTTP {resp.status}")
+            resp.raise_for_status()
+            if resp.content_length is not None and resp.content_length > self.max_bytes:
+                raise FetchError(f"{url} is larger than {self.max_bytes} bytes")
+            chunks = []
+            size = 0
+            async for chunk in resp.content.iter_chunked(64 * 1024):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise FetchError(f"{url} is larger than {self.max_bytes} bytes")
+                chunks.append(chunk)
+            return b"".join(chunks), resp.headers.get("ETag")
@@ -0,0 +1,331 @@
+from typing import Optional, Dict, List, Callable, NamedTuple
+import logging
+import asyncio
+import sqlite3
+import json
+import time
+
+from diffuser_discord.bot.image_client import ImageClient, ImageProgress, ERROR_IMAGE
+from diffuser_discord.bot.fair_queue import FairScheduler
+from diffuser_discord.bot import metrics
+
+QUEUED = "queued"
+# handed to the FairScheduler, waiting there for a slot
+WAITING = "waiting"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class Job(NamedTuple):
+    id: int
+    kind: str
+    prompts: List[str]
+    seed: int
+    hparams: Dict
+    image_url: Optional[str]
+    user_id: int
+    guild_id: Optional[int]
+    channel_id: Optional[int]
+    message_id: Optional[int]
+    attempts: int
+    # for "upscale" jobs, the draft and which of its images
+    draft_id: Optional[str] = None
+    index: Optional[int] = None
+
+
+class JobQueue:
+    """
+    SQLite table of generation jobs and their state, so queued and running work survives a restart.
+
+    Jobs go queued -> waiting -> running -> done/failed. A job is only marked done once its result exists, so
+    anything waiting or running when the process died is handed out again on startup (at-least-once). Only
+    running spends an attempt, waiting jobs never reached the client.
+    """
+
+    def __init__(self, path: Optional[str] = ":memory:", max_attempts: Optional[int] = 3):
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                state TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                request TEXT NOT NULL,
+                user_id INTEGER,
+                guild_id INTEGER,
+                channel_id INTEGER,
+                message_id INTEGER,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                link TEXT,
+                full_link TEXT,
+                error TEXT,
+                created REAL,
+                updated REAL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+
+    def enqueue(
+        self,
+        kind: str,
+        prompts: List[str],
+        seed: int,
+        hparams: Dict,
+        user_id: int,
+        guild_id: Optional[int] = None,
+        image_url: Optional[str] = None,
+        channel_id: Optional[int] = None,
+        message_id: Optional[int] = None,
+        draft_id: Optional[str] = None,
+        index: Optional[int] = None,
+    ) -> int:
+        request = json.dumps(
+            {
+                "prompts": prompts,
+                "seed": seed,
+                "hparams": hparams,
+                "image_url": image_url,
+                "draft_id": draft_id,
+                "index": index,
+            }
+        )
+        now = time.time()
+        cursor = self.conn.execute(
+            "INSERT INTO jobs (state, kind, request, user_id, guild_id, channel_id, message_id, created, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (QUEUED, kind, request, user_id, guild_id, channel_id, message_id, now, now),
+        )
+        return cursor.lastrowid
+
+    def dequeue(self, limit: int) -> List[Job]:
+        """
+        Moves up to `limit` of the oldest queued jobs to waiting in one transaction.
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.conn.execute(
+                "SELECT id, kind, request, user_id, guild_id, channel_id, message_id, attempts FROM jobs "
+                "WHERE state = ? ORDER BY id LIMIT ?",
+                (QUEUED, limit),
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE jobs SET state = ?, updated = ? WHERE id = ?", [(WAITING, time.time(), row[0]) for row in rows]
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        jobs = []
+        for job_id, kind, request, user_id, guild_id, channel_id, message_id, attempts in rows:
+            request = json.loads(request)
+            jobs.append(
+                Job(
+                    job_id,
+                    kind,
+                    request["prompts"],
+                    request["seed"],
+                    request["hparams"],
+                    request["image_url"],
+                    user_id,
+                    guild_id,
+                    channel_id,
+                    message_id,
+                    attempts,
+                    request.get("draft_id"),
+                    request.get("index"),
+                )
+            )
+        return jobs
+
+    def mark_running(self, job_id: int) -> int:
+        """
+        Marks a waiting job as started and returns its attempt number.
+        """
+        self.conn.execute(
+            "UPDATE jobs SET state = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+            (RUNNING, time.time(), job_id),
+        )
+        return self.conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+
+    def complete(self, job_id: int, link: str, full_link: Optional[str]):
+        state = FAILED if link == ERROR_IMAGE else DONE
+        self.conn.execute(
+            "UPDATE jobs SET state = ?, link = ?, full_link = ?, updated = ? WHERE id = ?",
+            (state, link, full_link, time.time(), job_id),
+        )
+
+    def retry_or_fail(self, job_id: int, attempts: int, error: str) -> str:
+        state = QUEUED if attempts < self.max_attempts else FAILED
+        self.conn.execute(
+            "UPDATE jobs SET state = ?, error = ?, updated = ? WHERE id = ?", (state, error, time.time(), job_id)
+        )
+        return state
+
+    def requeue_running(self) -> int:
+        """
+        Puts jobs a previous process was running back in the queue, failing those out of attempts, along with the
+        ones it had waiting, which keep their attempts.
+        """
+        now = time.time()
+        self.conn.execute(
+            "UPDATE jobs SET state = ?, error = 'interrupted', updated = ? WHERE state = ? AND attempts >= ?",
+            (FAILED, now, RUNNING, self.max_attempts),
+        )
+        cursor = self.conn.execute(
+            "UPDATE jobs SET state = ?, updated = ? WHERE state IN (?, ?)", (QUEUED, now, WAITING, RUNNING)
+        )
+        return cursor.rowcount
+
+    def prune(self, older_than: float):
+        self.conn.execute(
+            "DELETE FROM jobs WHERE state IN (?, ?) AND updated < ?", (DONE, FAILED, time.time() - older_than)
+        )
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+
+class JobListener:
+    """
+    Receives a job's queue position and progress, e.g. to edit the Discord message it was started from.
+    """
+
+    async def on_position(self, position: int):
+        pass
+
+    async def on_progress(self, progress: ImageProgress):
+        pass
+
+
+class JobRunner:
+    """
+    Moves jobs from the JobQueue through the FairScheduler to the ImageClient.
+
+    Every queued job is drained into the FairScheduler as soon as it's seen (`dequeue_batch` at a time), since
+    the scheduler, not the table, decides the order and reports queue positions. A job is only marked running
+    once it gets a slot, so concurrent jobs still reach the client together and can be coalesced.
+
+    Jobs found in the queue at startup have no listener from a live view, `resume_listener(job)` provides one
+    instead.
+    """
+
+    def __init__(
+        self,
+        job_queue: JobQueue,
+        img_client: ImageClient,
+        scheduler: FairScheduler,
+        resume_listener: Optional[Callable[[Job], JobListener]] = None,
+        dequeue_batch: Optional[int] = 8,
+        keep_finished: Optional[float] = 24 * 3600,
+    ):
+        self.job_queue = job_queue
+        self.img_client = img_client
+        self.scheduler = scheduler
+        self.resume_listener = resume_listener or (lambda job: JobListener())
+        self.dequeue_batch = dequeue_batch
+        self.keep_finished = keep_finished
+        self.listeners: Dict[int, JobListener] = {}
+        self.waiters: Dict[int, asyncio.Future] = {}
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.wakeup = None
+        self.loop_task = None
+
+    def start(self):
+        self.job_queue.prune(self.keep_finished)
+        resumed = self.job_queue.requeue_running()
+        logging.info(f"Job queue {self.job_queue.stats()}, resuming {resumed} interrupted jobs")
+        self.wakeup = asyncio.Event()
+        self.wakeup.set()
+        self.loop_task = asyncio.create_task(self._loop())
+
+    async def submit(
+        self,
+        listener: JobListener,
+        kind: str,
+        prompts: List[str],
+        seed: int,
+        hparams: Dict,
+        user_id: int,
+        guild_id: Optional[int] = None,
+        image_url: Optional[str] = None,
+        channel_id: Optional[int] = None,
+        message_id: Optional[int] = None,
+        draft_id: Optional[str] = None,
+        index: Optional[int] = None,
+    ) -> ImageProgress:
+        """
+        Durably queues a job and waits for its final result, reporting progress to `listener` on the way.
+        """
+        job_id = self.job_queue.enqueue(
+            kind, prompts, seed, hparams, user_id, guild_id, image_url, channel_id, message_id, draft_id, index
+        )
+        future = asyncio.get_running_loop().create_future()
+        self.listeners[job_id] = listener
+        self.waiters[job_id] = future
+        self.wakeup.set()
+        return await future
+
+    async def _loop(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while True:
+                jobs = self.job_queue.dequeue(self.dequeue_batch)
+                if not jobs:
+                    break
+                for job in jobs:
+                    self.tasks[job.id] = asyncio.create_task(self._run(job))
+
+    async def _stream(self, job: Job, listener: JobListener) -> ImageProgress:
+        if job.kind == "img2img":
+            stream = self.img_client.stream_images_from_image(job.prompts, job.image_url, job.seed, job.hparams)
+        elif job.kind == "upscale":
+            stream = self.img_client.stream_upscale(job.draft_id, job.index, job.prompts[0], job.seed, job.hparams)
+        else:
+            stream = self.img_client.stream_images(job.prompts, job.seed, job.hparams)
+        progress = ImageProgress(ERROR_IMAGE, len(job.prompts), len(job.prompts))
+        async for progress in stream:
+            try:
+                await listener.on_progress(progress)
+            except Exception as e:
+                # a deleted message or Discord hiccup shouldn't cost the result
+                logging.error(f"Job {job.id} listener failed: {e!r}")
+        return progress
+
+    def _finish(self, job: Job, progress: Optional[ImageProgress] = None, error: Optional[Exception] = None):
+        self.listeners.pop(job.id, None)
+        waiter = self.waiters.pop(job.id, None)
+        if waiter is None or waiter.done():
+            return
+        if error is not None:
+            waiter.set_exception(error)
+        else:
+            waiter.set_result(progress)
+
+    async def _run(self, job: Job):
+        if job.id not in self.listeners:
+            self.listeners[job.id] = self.resume_listener(job)
+        listener = self.listeners[job.id]
+        cost = self.scheduler.estimate_cost(len(job.prompts), job.kind)
+        try:
+            with metrics.trace(
+                job.kind, user=job.user_id, guild=job.guild_id, prompts=len(job.prompts), job=job.id
+            ) as trace:
+                queued = time.time()
+                async with self.scheduler.slot(job.user_id, job.guild_id, cost, on_position=listener.on_position):
+                    trace.add("queue_wait", time.time() - queued)
+                    job = job._replace(attempts=self.job_queue.mark_running(job.id))
+                    progress = await self._stream(job, listener)
+                    if progress.link == ERROR_IMAGE:
+                        trace.status = "error"
+            self.job_queue.complete(job.id, progress.link, progress.full_link)
+            self._finish(job, progress)
+        except (Exception, asyncio.CancelledError) as e:
+            logging.error(f"Job {job.id} failed on attempt {job.attempts}: {e!r}")
+            # a retried job keeps its listener and waiter
+            if self.job_queue.retry_or_fail(job.id, job.attempts, repr(e)) == FAILED:
+                self._finish(job, error=e if isinstance(e, Exception) else RuntimeError("Job was cancelled"))
+            self.wakeup.set()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            self.tasks.pop(job.id, None)
@@ -0,0 +1,180 @@
+from typing import Optional, Dict, List, Tuple
+import logging
+import asyncio
+import time
+
+import discord
+
+from diffuser_discord.bot import metrics
+
+# interaction tokens last 15 minutes, stop using them a little early so an edit doesn't race the expiry
+INTERACTION_TTL = 14 * 60
+# Discord allows about 5 edits per 5 seconds per channel, and as many per interaction token
+EDITS_PER_PERIOD = 5
+EDIT_PERIOD = 5.0
+
+
+class _Bucket:
+    """
+    Token bucket mirroring one of Discord's rate limits, so edits wait their turn here rather than on a 429.
+    """
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class MessageTarget:
+    """
+    A message to keep up to date. While `interaction` is fresh its token edits the message, which is rate
+    limited separately from the channel, after that (or without one) the bot edits it through the channel.
+    `content` is posted with the final state if the message turns out to be gone.
+    """
+
+    def __init__(
+        self,
+        channel_id: int,
+        message_id: int,
+        interaction: Optional[discord.Interaction] = None,
+        content: Optional[str] = None,
+    ):
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.interaction = interaction
+        self.content = content
+        self.created = time.time() if interaction is None else interaction.created_at.timestamp()
+
+
+class _Message:
+    def __init__(self, key: int, target: MessageTarget):
+        self.key = key
+        self.target = target
+        # latest value of each edit() argument not sent yet, newer updates overwrite older ones
+        self.fields: Dict = {}
+        self.final = False
+        self.waiters: List[asyncio.Future] = []
+        self.last_sent = 0.0
+        self.wake = asyncio.Event()
+        self.task = None
+
+
+class MessageUpdater:
+    """
+    Coalesces edits per message so progress updates never wait on (or trip) Discord's rate limits.
+
+    update() only records the message's latest state and returns; one task per message sends it at most every
+    `min_interval` seconds, so intermediate states superseded in the meantime are never sent. Final states skip
+    the interval, but every edit still waits for a token from its channel's (or interaction's) bucket.
+    """
+
+    def __init__(
+        self,
+        client: discord.Client,
+        min_interval: Optional[float] = 2.0,
+        edits_per_period: Optional[int] = EDITS_PER_PERIOD,
+        edit_period: Optional[float] = EDIT_PERIOD,
+        interaction_ttl: Optional[float] = INTERACTION_TTL,
+    ):
+        self.client = client
+        self.min_interval = min_interval
+        self.edits_per_period = edits_per_period
+        self.edit_period = edit_period
+        self.interaction_ttl = interaction_ttl
+        self.messages: Dict[int, _Message] = {}
+        self.buckets: Dict[Tuple[str, int], _Bucket] = {}
+
+    def update(self, target: MessageTarget, final: bool = False, **fields) -> asyncio.Future:
+        """
+        Queues `fields` (keyword arguments of Message.edit) for the message. The returned future resolves to
+        whether this state, or a newer one, made it to Discord, only the final update is worth awaiting.
+        """
+        message = self.messages.get(target.message_id)
+        if message is None:
+            message = self.messages[target.message_id] = _Message(target.message_id, target)
+        elif message.fields:
+            metrics.REGISTRY.inc("diffuser_discord_edits_coalesced_total", "Message edits superseded before sending")
+        # a newer interaction on the same message, e.g. the next 🔄 press, brings a fresh token
+        message.target = target
+        message.fields.update(fields)
+        if final:
+            message.final = True
+            message.wake.set()
+        future = asyncio.get_running_loop().create_future()
+        message.waiters.append(future)
+        if message.task is None:
+            message.task = asyncio.create_task(self._flush(message))
+        return future
+
+    async def _flush(self, message: _Message):
+        try:
+            while message.fields:
+                delay = message.last_sent + self.min_interval - time.time()
+                if delay > 0 and not message.final:
+                    message.wake.clear()
+                    try:
+                        await asyncio.wait_for(message.wake.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                fields, final, waiters = message.fields, message.final, message.waiters
+                message.fields, message.final, message.waiters = {}, False, []
+                sent = True
+                try:
+                    await self._send(message.target, fields, final)
+                except Exception as e:
+                    logging.error(f"Editing message {message.target.message_id} failed: {e!r}")
+                    sent = False
+                message.last_sent = time.time()
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(sent)
+                if final and not message.fields:
+                    del self.messages[message.key]
+                    if message.target.interaction is not None:
+                        self.buckets.pop(("interaction", message.target.interaction.id), None)
+        finally:
+            message.task = None
+
+    def _bucket(self, key: Tuple[str, int]) -> _Bucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = _Bucket(self.edits_per_period, self.edit_period)
+        return bucket
+
+    async def _send(self, target: MessageTarget, fields: Dict, final: bool):
+        if target.interaction is not None and time.time() - target.created < self.interaction_ttl:
+            await self._bucket(("interaction", target.interaction.id)).acquire()
+            try:
+                await target.interaction.edit_original_response(**fields)
+                return
+            except discord.HTTPException as e:
+                # an invalidated token or a deleted message, the channel handles (or reports) both
+                if e.status not in (401, 404):
+                    raise
+        # stale or failed, later edits go straight to the channel
+        target.interaction = None
+        channel = self.client.get_channel(target.channel_id) or await self.client.fetch_channel(target.channel_id)
+        await self._bucket(("channel", target.channel_id)).acquire()
+        try:
+            await channel.get_partial_message(target.message_id).edit(**fields)
+        except discord.NotFound:
+            if not final:
+                raise
+            metrics.REGISTRY.inc("diffuser_discord_edit_fallbacks_total", "Final results posted as a new message")
+            message = await channel.send(
+                content=target.content, **{key: value for key, value in fields.items() if key in ("embed", "view")}
+            )
+            target.message_id = message.id
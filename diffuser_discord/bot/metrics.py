@@ -0,0 +1,192 @@
+from typing import Optional, Dict, List, Tuple, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import logging
+import bisect
+import json
+import time
+import uuid
+
+SECONDS_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0]
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(**labels) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Registry:
+    """
+    Minimal in-process metrics store rendered in the Prometheus text format, so no client library is needed.
+    """
+
+    def __init__(self, buckets: Optional[List[float]] = None):
+        self.buckets = buckets or SECONDS_BUCKETS
+        self.lock = threading.Lock()
+        self.help: Dict[str, Tuple[str, str]] = {}
+        self.values: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, List]] = {}
+
+    def _declare(self, name: str, kind: str, help: str):
+        self.help.setdefault(name, (kind, help))
+
+    def inc(self, name: str, help: str, value: float = 1.0, **labels):
+        with self.lock:
+            self._declare(name, "counter", help)
+            series = self.values.setdefault(name, {})
+            key = _labels(**labels)
+            series[key] = series.get(key, 0.0) + value
+
+    def set_max(self, name: str, help: str, value: float, **labels):
+        with self.lock:
+            self._declare(name, "gauge", help)
+            series = self.values.setdefault(name, {})
+            key = _labels(**labels)
+            series[key] = max(series.get(key, value), value)
+
+    def observe(self, name: str, help: str, value: float, **labels):
+        with self.lock:
+            self._declare(name, "histogram", help)
+            series = self.histograms.setdefault(name, {})
+            # per-bucket counts, then sum and count
+            state = series.setdefault(_labels(**labels), [[0] * len(self.buckets), 0.0, 0])
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name, (kind, help) in sorted(self.help.items()):
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in self.values.get(name, {}).items():
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+                for labels, (counts, total, count) in self.histograms.get(name, {}).items():
+                    cumulative = 0
+                    for bound, bucket_count in zip(self.buckets, counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{_format_labels(labels, ('le', str(bound)))} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Trace:
+    """
+    Timing spans and attributes for one user request, accumulated by name as the request moves through the
+    queue, the worker and the output sink.
+    """
+
+    def __init__(self, kind: str, **attrs):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.attrs = attrs
+        self.spans: Dict[str, float] = {}
+        self.status = "ok"
+        self.start = time.time()
+        self.duration = None
+
+    def add(self, name: str, seconds: float):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def to_dict(self) -> Dict:
+        return {
+            "trace_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "duration": round(self.duration or time.time() - self.start, 4),
+            "spans": {name: round(seconds, 4) for name, seconds in self.spans.items()},
+            **self.attrs,
+        }
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def trace(kind: str, registry: Optional[Registry] = None, **attrs) -> Iterator[Trace]:
+    """
+    Makes a new Trace current for the enclosed code (and tasks it starts), then records it into the registry
+    and logs it as one JSON line.
+    """
+    registry = registry or REGISTRY
+    current = Trace(kind, **attrs)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    except BaseException:
+        current.status = "error"
+        raise
+    finally:
+        _current_trace.reset(token)
+        current.duration = time.time() - current.start
+        registry.inc("diffuser_requests_total", "Generation requests", kind=kind, status=current.status)
+        registry.observe(
+            "diffuser_request_seconds", "End to end request latency", current.duration, kind=kind, status=current.status
+        )
+        for name, seconds in current.spans.items():
+            registry.observe("diffuser_span_seconds", "Time spent per request in each span", seconds, span=name)
+        gpu_peak = current.attrs.get("gpu_peak_bytes")
+        if gpu_peak is not None:
+            registry.set_max(
+                "diffuser_gpu_peak_bytes",
+                "Highest GPU memory allocated by a request",
+                gpu_peak,
+                device=current.attrs.get("device"),
+            )
+        logging.info(json.dumps({"event": "request_trace", **current.to_dict()}, default=str))
+
+
+@contextmanager
+def span(name: str):
+    """
+    Times the enclosed code into the current trace, a no-op outside of one.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        current = _current_trace.get()
+        if current is not None:
+            current.add(name, time.time() - start)
+
+
+def annotate(**attrs):
+    current = _current_trace.get()
+    if current is not None:
+        current.attrs.update(attrs)
+
+
+def record_worker_stats(stats: Optional[Dict]):
+    """
+    Merges the spans and GPU high-water mark a worker process reported into the current trace.
+    """
+    current = _current_trace.get()
+    if current is None or not stats:
+        return
+    for name, seconds in stats.get("spans", {}).items():
+        current.add(name, seconds)
+    current.attrs["device"] = stats.get("device")
+    gpu_peak = stats.get("gpu_peak_bytes")
+    if gpu_peak is not None:
+        current.attrs["gpu_peak_bytes"] = max(current.attrs.get("gpu_peak_bytes", 0), gpu_peak)
@@ -0,0 +1,189 @@
+from typing import Optional, Dict, List, AsyncIterator, Tuple, Callable, Awaitable
+import hashlib
+import logging
+import asyncio
+import sqlite3
+import json
+import time
+
+from diffuser_discord.bot.image_client import ImageClient, ImageProgress, ERROR_IMAGE
+from diffuser_discord.bot import metrics
+from diffuser_discord.ml_worker import drafts
+
+
+def request_key(backend: str, kind: str, prompts: List[str], seed: int, hparams: Dict, image_url: str = None) -> str:
+    request = {
+        "backend": backend,
+        "kind": kind,
+        "prompts": prompts,
+        "seed": seed,
+        "hparams": hparams,
+        "image_url": image_url,
+    }
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    SQLite table of request key -> preview and full resolution links, along with how long the original
+    generation took.
+    """
+
+    def __init__(self, path: Optional[str] = ":memory:"):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, link TEXT, duration REAL, created REAL)"
+        )
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(results)")]
+        if "full_link" not in columns:
+            self.conn.execute("ALTER TABLE results ADD COLUMN full_link TEXT")
+        self.conn.commit()
+
+    def get(self, key: str) -> Optional[Tuple[str, Optional[str], float]]:
+        return self.conn.execute("SELECT link, full_link, duration FROM results WHERE key = ?", (key,)).fetchone()
+
+    def put(self, key: str, link: str, full_link: Optional[str], duration: float):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results (key, link, full_link, duration, created) VALUES (?, ?, ?, ?, ?)",
+            (key, link, full_link, duration, time.time()),
+        )
+        self.conn.commit()
+
+
+class CachingClient(ImageClient):
+    """
+    Wraps another client so concurrent identical requests share one generation and repeats are served from cache.
+    """
+
+    def __init__(self, client: ImageClient, cache_path: Optional[str] = ":memory:", backend: Optional[str] = None):
+        self.client = client
+        self.cache_path = cache_path
+        self.backend = backend or type(client).__name__
+        self.cache = None
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.joins = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @property
+    def max_prompts(self) -> Optional[int]:
+        return self.client.max_prompts
+
+    @property
+    def supports_img2img(self) -> bool:
+        return self.client.supports_img2img
+
+    @property
+    def concurrency(self) -> Optional[int]:
+        return self.client.concurrency
+
+    def init(self):
+        self.client.init()
+        self.cache = ResultCache(self.cache_path)
+
+    def warmup(self):
+        self.client.warmup()
+
+    def stats(self) -> Dict:
+        total = self.hits + self.joins + self.misses
+        return {
+            "hits": self.hits,
+            "joins": self.joins,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.joins) / total if total else 0.0,
+            "saved_seconds": round(self.saved_seconds, 1),
+        }
+
+    async def _lookup(self, key: str) -> Optional[Tuple[str, Optional[str]]]:
+        cached = self.cache.get(key)
+        if cached is not None:
+            link, full_link, duration = cached
+            self.hits += 1
+            self.saved_seconds += duration
+            metrics.annotate(cache="hit")
+            logging.info(f"Result cache hit {self.stats()}")
+            return link, full_link
+        inflight = self.inflight.get(key)
+        if inflight is not None:
+            self.joins += 1
+            metrics.annotate(cache="join")
+            link, full_link, duration = await asyncio.shield(inflight)
+            self.saved_seconds += duration
+            logging.info(f"Joined in-flight request {self.stats()}")
+            return link, full_link
+        return None
+
+    async def _stream(
+        self, key: str, stream: Callable[[], AsyncIterator[ImageProgress]], total: int
+    ) -> AsyncIterator[ImageProgress]:
+        found = await self._lookup(key)
+        if found is not None:
+            link, full_link = found
+            yield ImageProgress(link, total, total, full_link)
+            return
+        self.misses += 1
+        metrics.annotate(cache="miss")
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        start = time.time()
+        try:
+            async for progress in stream():
+                if progress.final:
+                    duration = time.time() - start
+                    future.set_result((progress.link, progress.full_link, duration))
+                    if progress.link != ERROR_IMAGE:
+                        self.cache.put(key, progress.link, progress.full_link, duration)
+                yield progress
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            raise
+        finally:
+            self.inflight.pop(key, None)
+            if not future.done():
+                future.set_exception(RuntimeError("Request was abandoned before it finished"))
+            # mark the exception as retrieved when nobody joined this request
+            future.exception()
+
+    async def _last(self, stream: AsyncIterator[ImageProgress]) -> str:
+        link = ERROR_IMAGE
+        async for progress in stream:
+            link = progress.link
+        return link
+
+    async def generate_images(self, prompts: List[str], seed: int, hparams: Dict) -> str:
+        return await self._last(self.stream_images(prompts, seed, hparams))
+
+    async def generate_images_from_image(self, prompts: List[str], image_url: str, seed: int, hparams: Dict) -> str:
+        return await self._last(self.stream_images_from_image(prompts, image_url, seed, hparams))
+
+    async def stream_images(self, prompts: List[str], seed: int, hparams: Dict) -> AsyncIterator[ImageProgress]:
+        if drafts.last_stage(hparams) != "stage_3":
+            # a draft's id points at intermediates in one worker, a cached link couldn't be upscaled from them
+            async for progress in self.client.stream_images(prompts, seed, hparams):
+                yield progress
+            return
+        key = request_key(self.backend, "txt2img", prompts, seed, hparams)
+        async for progress in self._stream(
+            key, lambda: self.client.stream_images(prompts, seed, hparams), len(prompts)
+        ):
+            yield progress
+
+    async def stream_images_from_image(
+        self, prompts: List[str], image_url: str, seed: int, hparams: Dict
+    ) -> AsyncIterator[ImageProgress]:
+        key = request_key(self.backend, "img2img", prompts, seed, hparams, image_url=image_url)
+        async for progress in self._stream(
+            key, lambda: self.client.stream_images_from_image(prompts, image_url, seed, hparams), len(prompts)
+        ):
+            yield progress
+
+    async def stream_upscale(
+        self, draft_id: Optional[str], index: int, prompt: str, seed: int, hparams: Dict
+    ) -> AsyncIterator[ImageProgress]:
+        key = request_key(self.backend, "upscale", [prompt], seed, {**hparams, "draft_id": draft_id, "index": index})
+        async for progress in self._stream(
+            key, lambda: self.client.stream_upscale(draft_id, index, prompt, seed, hparams), 1
+        ):
+            yield progress
@@ -0,0 +1,204 @@
+from typing import Optional, Dict, List, AsyncIterator, Tuple, Callable
+from collections import OrderedDict
+import logging
+import time
+
+from diffuser_discord.bot.image_client import ImageClient, ImageProgress, ERROR_IMAGE
+from diffuser_discord.bot import metrics
+
+
+class _Backend:
+    def __init__(self, name: str, client: ImageClient, seconds_per_image: float):
+        self.name = name
+        self.client = client
+        self.seconds_per_image = seconds_per_image
+        self.in_flight_images = 0
+        self.requests = 0
+        self.failures = 0
+
+    def supports(self, kind: str, num_prompts: int) -> bool:
+        if kind == "img2img" and not self.client.supports_img2img:
+            return False
+        return self.client.max_prompts is None or num_prompts <= self.client.max_prompts
+
+    def estimate_latency(self, num_prompts: int) -> float:
+        """
+        Seconds until a new request of `num_prompts` would finish, assuming the images already in flight are
+        ahead of it and the backend works through `concurrency` requests at a time.
+        """
+        if self.client.concurrency is None:
+            return self.seconds_per_image * num_prompts
+        return self.seconds_per_image * (self.in_flight_images + num_prompts) / max(1, self.client.concurrency)
+
+    def stats(self) -> Dict:
+        return {
+            "in_flight_images": self.in_flight_images,
+            "seconds_per_image": round(self.seconds_per_image, 3),
+            "requests": self.requests,
+            "failures": self.failures,
+        }
+
+
+class RoutingClient(ImageClient):
+    """
+    Sends each request to the first backend (in the given order of preference) that supports it and whose
+    estimated latency is within `max_latency`, spilling over to the next ones as queues grow, e.g. a local GPU
+    first and Modal once it's backed up. When every backend is over the limit the one with the lowest estimate
+    is used. A request that fails on one backend is retried on the others that support it.
+
+    Estimates come from each backend's in-flight images and an exponentially weighted average of its observed
+    seconds per image, starting from `initial_seconds_per_image`.
+    """
+
+    def __init__(
+        self,
+        backends: List[Tuple[str, ImageClient]],
+        max_latency: Optional[float] = 30.0,
+        smoothing: Optional[float] = 0.2,
+        initial_seconds_per_image: Optional[float] = 5.0,
+        max_drafts: Optional[int] = 1024,
+    ):
+        self.backends = [_Backend(name, client, initial_seconds_per_image) for name, client in backends]
+        self.max_latency = max_latency
+        self.smoothing = smoothing
+        self.max_drafts = max_drafts
+        # draft id -> the backend holding its intermediates
+        self.draft_backends: "OrderedDict[str, _Backend]" = OrderedDict()
+
+    @property
+    def max_prompts(self) -> Optional[int]:
+        limits = [backend.client.max_prompts for backend in self.backends]
+        return None if None in limits else max(limits)
+
+    @property
+    def supports_img2img(self) -> bool:
+        return any(backend.client.supports_img2img for backend in self.backends)
+
+    @property
+    def concurrency(self) -> Optional[int]:
+        limits = [backend.client.concurrency for backend in self.backends]
+        return None if None in limits else sum(limits)
+
+    def init(self):
+        for backend in self.backends:
+            backend.client.init()
+
+    def warmup(self):
+        for backend in self.backends:
+            backend.client.warmup()
+
+    def stats(self) -> Dict:
+        return {backend.name: backend.stats() for backend in self.backends}
+
+    def _candidates(self, kind: str, num_prompts: int) -> List[_Backend]:
+        """
+        Supporting backends in the order to try them: the preferred ones within the latency limit, then the
+        rest by estimated latency.
+        """
+        supported = [backend for backend in self.backends if backend.supports(kind, num_prompts)]
+        within = [backend for backend in supported if backend.estimate_latency(num_prompts) <= self.max_latency]
+        over = sorted(
+            (backend for backend in supported if backend not in within),
+            key=lambda backend: backend.estimate_latency(num_prompts),
+        )
+        return within + over
+
+    async def _route(
+        self,
+        kind: str,
+        num_prompts: int,
+        stream: Callable[[ImageClient], AsyncIterator[ImageProgress]],
+        candidates: Optional[List[_Backend]] = None,
+    ) -> AsyncIterator[ImageProgress]:
+        candidates = candidates if candidates is not None else self._candidates(kind, num_prompts)
+        if not candidates:
+            raise ValueError(f"No backend supports {kind} with {num_prompts} prompts")
+        for attempt, backend in enumerate(candidates):
+            last_attempt = attempt == len(candidates) - 1
+            if attempt > 0 or backend is not self.backends[0]:
+                logging.info(f"Routing {kind} x{num_prompts} to {backend.name}, backends {self.stats()}")
+            metrics.annotate(backend=backend.name)
+            metrics.REGISTRY.inc(
+                "diffuser_backend_requests_total", "Requests routed to each backend", backend=backend.name, kind=kind
+            )
+            backend.requests += 1
+            backend.in_flight_images += num_prompts
+            start = time.time()
+            progress = None
+            backend_stream = stream(backend.client)
+            try:
+                async for progress in backend_stream:
+                    if progress.final and progress.link == ERROR_IMAGE and not last_attempt:
+                        break
+                    yield progress
+            except Exception as e:
+                if last_attempt:
+                    raise
+                logging.error(f"{backend.name} failed {kind}: {e!r}")
+                progress = None
+            finally:
+                # run the backend's cleanup now rather than whenever the loop finalizes an abandoned stream
+                await backend_stream.aclose()
+                backend.in_flight_images -= num_prompts
+            if progress is not None and progress.final and progress.link != ERROR_IMAGE:
+                seconds_per_image = (time.time() - start) / num_prompts
+                backend.seconds_per_image += self.smoothing * (seconds_per_image - backend.seconds_per_image)
+                if progress.draft_id is not None:
+                    self._remember_draft(progress.draft_id, backend)
+                return
+            backend.failures += 1
+            metrics.REGISTRY.inc(
+                "diffuser_backend_failures_total", "Failed requests per backend", backend=backend.name, kind=kind
+            )
+            if last_attempt:
+                return
+            metrics.annotate(fallback=True)
+
+    def _remember_draft(self, draft_id: str, backend: _Backend):
+        self.draft_backends[draft_id] = backend
+        while len(self.draft_backends) > self.max_drafts:
+            self.draft_backends.popitem(last=False)
+
+    async def _last(self, stream: AsyncIterator[ImageProgress]) -> str:
+        link = ERROR_IMAGE
+        async for progress in stream:
+            link = progress.link
+        return link
+
+    async def generate_images(self, prompts: List[str], seed: int, hparams: Dict) -> str:
+        return await self._last(self.stream_images(prompts, seed, hparams))
+
+    async def generate_images_from_image(self, prompts: List[str], image_url: str, seed: int, hparams: Dict) -> str:
+        return await self._last(self.stream_images_from_image(prompts, image_url, seed, hparams))
+
+    async def stream_images(self, prompts: List[str], seed: int, hparams: Dict) -> AsyncIterator[ImageProgress]:
+        async for progress in self._route(
+            "txt2img", len(prompts), lambda client: client.stream_images(prompts, seed, hparams)
+        ):
+            yield progress
+
+    async def stream_images_from_image(
+        self, prompts: List[str], image_url: str, seed: int, hparams: Dict
+    ) -> AsyncIterator[ImageProgress]:
+        async for progress in self._route(
+            "img2img", len(prompts), lambda client: client.stream_images_from_image(prompts, image_url, seed, hparams)
+        ):
+            yield progress
+
+    async def stream_upscale(
+        self, draft_id: Optional[str], index: int, prompt: str, seed: int, hparams: Dict
+    ) -> AsyncIterator[ImageProgress]:
+        """
+        Upscales on the backend that made the draft, the others can only regenerate the image.
+        """
+        candidates = self._candidates("upscale", 1)
+        owner = self.draft_backends.get(draft_id)
+        if owner is not None:
+            candidates = [owner] + [backend for backend in candidates if backend is not owner]
+        async for progress in self._route(
+            "upscale",
+            1,
+            lambda client: client.stream_upscale(draft_id, index, prompt, seed, hparams),
+            candidates,
+        ):
+            yield progress
@@ -0,0 +1,122 @@
+from typing import List, Optional, Tuple, Union, Iterator
+import random
+
+
+class _Choice:
+    def __init__(self, options: List["_Sequence"]):
+        self.options = options
+        self.size = sum(option.size for option in options)
+
+    def expansion(self, index: int) -> str:
+        for option in self.options:
+            if index < option.size:
+                return option.expansion(index)
+            index -= option.size
+        raise IndexError(index)
+
+
+class _Sequence:
+    def __init__(self, parts: List[Union[str, _Choice]]):
+        self.parts = parts
+        self.size = 1
+        for part in parts:
+            if isinstance(part, _Choice):
+                self.size *= part.size
+
+    def expansion(self, index: int) -> str:
+        # mixed radix with the first choice as the most significant digit, matching nested for-loops
+        out = []
+        for part in reversed(self.parts):
+            if isinstance(part, _Choice):
+                index, digit = divmod(index, part.size)
+                out.append(part.expansion(digit))
+            else:
+                out.append(part)
+        return "".join(reversed(out))
+
+
+def _parse_sequence(text: str, pos: int, in_choice: bool) -> Tuple[_Sequence, int]:
+    parts = []
+    literal = []
+    while pos < len(text):
+        c = text[pos]
+        if c == "\\" and pos + 1 < len(text) and text[pos + 1] in "{}\\":
+            literal.append(text[pos + 1])
+            pos += 2
+            continue
+        if in_choice and (c == "}" or text.startswith(", ", pos)):
+            break
+        if c == "{":
+            choice, end = _parse_choice(text, pos + 1)
+            if choice is not None:
+                if literal:
+                    parts.append("".join(literal))
+                    literal = []
+                parts.append(choice)
+                pos = end
+                continue
+        literal.append(c)
+        pos += 1
+    if literal:
+        parts.append("".join(literal))
+    return _Sequence(parts), pos
+
+
+def _parse_choice(text: str, pos: int) -> Tuple[Optional[_Choice], int]:
+    """
+    Parses the options of a `{...}` starting after the opening brace, returns None if it is never closed or empty.
+    """
+    options = []
+    start = pos
+    while pos < len(text):
+        option, pos = _parse_sequence(text, pos, in_choice=True)
+        options.append(option)
+        if pos >= len(text):
+            break
+        if text[pos] == "}":
+            if pos == start:
+                return None, pos
+            return _Choice(options), pos + 1
+        pos += 2
+    return None, pos
+
+
+class PromptTemplate:
+    """
+    a {photo, painting} of a {dog, cat}
+
+    Options are separated by ", " and may contain nested templates, use \\{ and \\} for literal braces. Expansions
+    are computed on demand by index so huge templates can be counted, paged and sampled without materializing them.
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        self.root, _ = _parse_sequence(template, 0, in_choice=False)
+
+    @property
+    def size(self) -> int:
+        return self.root.size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, index: int) -> str:
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        return self.root.expansion(index)
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(self.size):
+            yield self.root.expansion(index)
+
+    def num_pages(self, page_size: int) -> int:
+        return -(-self.size // page_size)
+
+    def page(self, page: int, page_size: int) -> List[str]:
+        start = (page % self.num_pages(page_size)) * page_size
+        return [self.root.expansion(index) for index in range(start, min(start + page_size, self.size))]
+
+    def sample(self, k: int, rng: Optional[random.Random] = None) -> List[str]:
+        rng = rng or random
+        indices = sorted(rng.sample(range(self.size), min(k, self.size)))
+        return [self.root.expansion(index) for index in indices]
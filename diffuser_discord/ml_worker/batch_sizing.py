@@ -0,0 +1,78 @@
+from typing import Callable, Dict, List, Optional
+import logging
+
+
+def is_oom_error(e: Exception) -> bool:
+    return type(e).__name__ == "OutOfMemoryError" or "out of memory" in str(e).lower()
+
+
+class AdaptiveBatchSizer:
+    """
+    Tracks the largest batch size that fits for each pipeline.
+
+    An OOM halves the size, or drops to the last size that succeeded if that is larger, and after `probe_after`
+    consecutive full-size successes the size is increased by one to probe for headroom again.
+    """
+
+    def __init__(self, probe_after: Optional[int] = 20):
+        self.probe_after = probe_after
+        self.sizes: Dict[str, int] = {}
+        self.known_good: Dict[str, int] = {}
+        self.successes: Dict[str, int] = {}
+
+    def get(self, pipeline: str, max_size: int) -> int:
+        return max(1, min(self.sizes.setdefault(pipeline, max_size), max_size))
+
+    def record_success(self, pipeline: str, size: int, max_size: int):
+        self.known_good[pipeline] = max(self.known_good.get(pipeline, 0), size)
+        if size < self.get(pipeline, max_size):
+            return
+        self.successes[pipeline] = self.successes.get(pipeline, 0) + 1
+        if self.successes[pipeline] >= self.probe_after and self.sizes[pipeline] < max_size:
+            self.sizes[pipeline] += 1
+            self.successes[pipeline] = 0
+            logging.info(f"Probing {pipeline} batch size {self.sizes[pipeline]}")
+
+    def record_oom(self, pipeline: str, size: int):
+        known_good = self.known_good.get(pipeline, 0)
+        if known_good >= size:
+            # what used to fit no longer does, forget it
+            known_good = 0
+        self.known_good[pipeline] = known_good
+        self.sizes[pipeline] = max(known_good, size // 2, 1)
+        self.successes[pipeline] = 0
+        logging.warning(f"OOM at {pipeline} batch size {size}, dropping to {self.sizes[pipeline]}")
+
+    def stats(self) -> Dict:
+        return {"sizes": dict(self.sizes), "known_good": dict(self.known_good)}
+
+
+def run_chunked(
+    fn: Callable[[List, int], List],
+    items: List,
+    sizer: AdaptiveBatchSizer,
+    pipeline: str,
+    max_size: int,
+    on_oom: Optional[Callable[[], None]] = None,
+) -> List:
+    """
+    Calls `fn(chunk, offset)` over `items` in chunks sized by `sizer`, retrying a chunk at a smaller size after an OOM.
+    """
+    results = []
+    i = 0
+    while i < len(items):
+        size = sizer.get(pipeline, max_size)
+        chunk = items[i : i + size]
+        try:
+            results.extend(fn(chunk, i))
+        except Exception as e:
+            if not is_oom_error(e) or len(chunk) == 1:
+                raise
+            # a short tail chunk halves from its own size, not the configured one
+            sizer.record_oom(pipeline, len(chunk))
+            if on_oom is not None:
+                on_oom()
+            continue
+        sizer.record_success(pipeline, len(chunk), max_size)
+        i += len(chunk)
+    return results
@@ -1,38 +1,143 @@
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple, Iterator
+from collections import OrderedDict
+import logging
+import time
 import gc
 
 from diffusers import DiffusionPipeline, IFImg2ImgPipeline, IFImg2ImgSuperResolutionPipeline, IFSuperResolutionPipeline
 import torch
 
+from diffuser_discord.ml_worker import staged_pipeline, drafts, memory_profiles
+from diffuser_discord.ml_worker.timing import StageTimer, gpu_peak_bytes
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of T5 embeddings keyed by (prompt, negative_prompt), bounded by entry count and tensor bytes.
+    """
+
+    def __init__(self, max_entries: Optional[int] = 256, max_bytes: Optional[int] = 1024**3):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Tuple[str, str], Tuple[torch.Tensor, torch.Tensor]]" = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _entry_bytes(entry: Tuple[torch.Tensor, torch.Tensor]) -> int:
+        return sum(t.element_size() * t.nelement() for t in entry)
+
+    def get(self, prompt: str, negative_prompt: str) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        key = (prompt, negative_prompt)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, prompt: str, negative_prompt: str, prompt_embeds: torch.Tensor, negative_embeds: torch.Tensor):
+        key = (prompt, negative_prompt)
+        entry = (prompt_embeds.cpu(), negative_embeds.cpu())
+        entry_bytes = self._entry_bytes(entry)
+        if entry_bytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size_bytes -= self._entry_bytes(self.entries.pop(key))
+        self.entries[key] = entry
+        self.size_bytes += entry_bytes
+        while len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size_bytes -= self._entry_bytes(evicted)
+
+    def stats(self) -> Dict:
+        return {"entries": len(self.entries), "bytes": self.size_bytes, "hits": self.hits, "misses": self.misses}
+
 
 class DeepFloydIF:
-    def __init__(self):
+    """
+    The three DeepFloyd stages plus img2img pipelines sharing their modules. `memory_profile` names one of
+    memory_profiles.PROFILES (or "auto" to pick by the card's memory) and decides placement, offloading,
+    attention slicing and VAE tiling.
+    """
+
+    def __init__(self, output_type: Optional[str] = "pil", memory_profile: Optional[str] = None):
+        # "np" skips stage_3's per-image PIL conversion and returns a float (N, H, W, C) array
+        self.output_type = output_type
+        total_vram = torch.cuda.get_device_properties(0).total_memory if torch.cuda.is_available() else None
+        self.profile_name, self.profile = memory_profiles.resolve(memory_profile, total_vram)
+        self.embedding_cache = PromptEmbeddingCache()
+        self.reload_count = 0
+        self.load_times: Dict[str, float] = {}
+        self.timer = StageTimer()
+        self.drafts = drafts.IntermediateCache()
         self.stage_1 = None
         self.stage_2 = None
         self.stage_3 = None
         self.stage_1_img2img = None
         self.stage_2_img2img = None
 
+    def _place(self, pipe: DiffusionPipeline):
+        if self.profile.placement == "gpu":
+            pipe.to("cuda")
+        elif self.profile.placement == "sequential_offload":
+            pipe.enable_sequential_cpu_offload()
+        else:
+            pipe.enable_model_cpu_offload()
+        if self.profile.attention_slicing:
+            pipe.enable_attention_slicing()
+        if self.profile.vae_tiling and getattr(pipe, "vae", None) is not None:
+            pipe.vae.enable_tiling()
+
     def load_weights(self):
+        start = time.time()
         self.stage_1 = DiffusionPipeline.from_pretrained(
             "DeepFloyd/IF-I-XL-v1.0", variant="fp16", torch_dtype=torch.float16
         )
-        self.stage_1.enable_model_cpu_offload()
-        self.stage_2 = DiffusionPipeline.from_pretrained(
-            "DeepFloyd/IF-II-L-v1.0", text_encoder=None, variant="fp16", torch_dtype=torch.float16
-        )
-        self.stage_2.enable_model_cpu_offload()
-        safety_modules = {
+        self._place(self.stage_1)
+        self.load_times["stage_1"] = time.time() - start
+
+        # stage_2 and stage_3 reuse stage_1's safety checker and watermarker instead of loading their own copies
+        shared_modules = {
             "feature_extractor": self.stage_1.feature_extractor,
             "safety_checker": self.stage_1.safety_checker,
         }
+
+        start = time.time()
+        self.stage_2 = DiffusionPipeline.from_pretrained(
+            "DeepFloyd/IF-II-L-v1.0",
+            text_encoder=None,
+            watermarker=self.stage_1.watermarker,
+            **shared_modules,
+            variant="fp16",
+            torch_dtype=torch.float16,
+        )
+        self._place(self.stage_2)
+        self.load_times["stage_2"] = time.time() - start
+
+        start = time.time()
         self.stage_3 = DiffusionPipeline.from_pretrained(
-            "stabilityai/stable-diffusion-x4-upscaler", **safety_modules, torch_dtype=torch.float16
+            "stabilityai/stable-diffusion-x4-upscaler", **shared_modules, torch_dtype=torch.float16
         )
-        self.stage_3.enable_model_cpu_offload()
+        self._place(self.stage_3)
+        self.load_times["stage_3"] = time.time() - start
 
+        start = time.time()
+        # built from the txt2img pipelines' modules, so they add no weights
         self.stage_1_img2img = IFImg2ImgPipeline(**self.stage_1.components)
         self.stage_2_img2img = IFImg2ImgSuperResolutionPipeline(**self.stage_2.components)
+        self.load_times["img2img"] = time.time() - start
+        logging.info(f"Loaded weights with the {self.profile_name} memory profile {self.load_times}")
+
+    def warmup(self) -> float:
+        """
+        Runs a tiny generation so kernels are compiled and offload hooks initialized before real traffic.
+        """
+        start = time.time()
+        self.generate_images(["warmup"], seeds=[0], hparams={})
+        return time.time() - start
 
     def reload_weights(self):
         del self.stage_1
@@ -40,56 +145,224 @@ class DeepFloydIF:
         del self.stage_3
         del self.stage_1_img2img
         del self.stage_2_img2img
+        self.release_memory()
+        self.load_weights()
+        self.reload_count += 1
+        logging.info(f"Reloaded weights ({self.reload_count} reloads)")
+
+    def release_memory(self):
         gc.collect()
         torch.cuda.empty_cache()
-        self.load_weights()
 
-    def generate_images(self, prompts: List[str], seed: int, hparams: Dict) -> List["Image"]:
-        generator = torch.manual_seed(seed)
-        prompt_embeds, negative_embeds = self.stage_1.encode_prompt(prompts)
+    def pop_peak_memory(self) -> Optional[int]:
+        return gpu_peak_bytes(reset=True)
+
+    def encode_prompts(
+        self, prompts: List[str], negative_prompt: Optional[str] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        with self.timer.time("encode_prompts"):
+            return self._encode_prompts(prompts, negative_prompt or "")
+
+    def _encode_prompts(self, prompts: List[str], negative_prompt: str) -> Tuple[torch.Tensor, torch.Tensor]:
+        cached = {prompt: self.embedding_cache.get(prompt, negative_prompt) for prompt in set(prompts)}
+        missing = [prompt for prompt, entry in cached.items() if entry is None]
+        if missing:
+            # encode_prompt wants a negative prompt per prompt, not a bare string alongside a list
+            prompt_embeds, negative_embeds = self.stage_1.encode_prompt(
+                missing, negative_prompt=[negative_prompt] * len(missing)
+            )
+            for i, prompt in enumerate(missing):
+                self.embedding_cache.put(prompt, negative_prompt, prompt_embeds[i : i + 1], negative_embeds[i : i + 1])
+                cached[prompt] = (prompt_embeds[i : i + 1], negative_embeds[i : i + 1])
+        logging.info(f"Prompt embedding cache {self.embedding_cache.stats()}")
+        device = self.stage_1._execution_device
+        prompt_embeds = torch.cat([cached[prompt][0].to(device) for prompt in prompts])
+        negative_embeds = torch.cat([cached[prompt][1].to(device) for prompt in prompts])
+        return prompt_embeds, negative_embeds
+
+    @staticmethod
+    def _generators(seeds: List[int]) -> List[torch.Generator]:
+        """
+        One generator per image, so each image only depends on its own seed and not on what it was batched with.
+        Separate generators also keep the pipelined stage threads off the shared global one.
+        """
+        return [torch.Generator().manual_seed(seed) for seed in seeds]
+
+    @staticmethod
+    def _stage_kwargs(state: Dict, stage: str) -> Dict:
+        kwargs = {"output_type": "pt"}
+        steps = drafts.stage_steps(state["hparams"], stage)
+        if steps is not None:
+            kwargs["num_inference_steps"] = steps
+        if drafts.last_stage(state["hparams"]) == stage:
+            # the draft is the final image, so it goes through the safety checker
+            kwargs["output_type"] = "np"
+        return kwargs
+
+    def _run_stage_1(self, state: Dict) -> Dict:
+        state["prompt_embeds"], state["negative_embeds"] = self.encode_prompts(
+            state["prompts"], state["hparams"].get("negative_prompt")
+        )
+        with self.timer.time("stage_1"):
+            state["images"] = self.stage_1(
+                prompt_embeds=state["prompt_embeds"],
+                negative_prompt_embeds=state["negative_embeds"],
+                generator=state["generator"],
+                **self._stage_kwargs(state, "stage_1"),
+            ).images
+        state["stage"] = "stage_1"
+        return state
+
+    def _run_stage_2(self, state: Dict) -> Dict:
+        with self.timer.time("stage_2"):
+            state["images"] = self.stage_2(
+                image=state["images"],
+                prompt_embeds=state.pop("prompt_embeds"),
+                negative_prompt_embeds=state.pop("negative_embeds"),
+                generator=state["generator"],
+                **self._stage_kwargs(state, "stage_2"),
+            ).images
+        state["stage"] = "stage_2"
+        return state
 
-        images = self.stage_1(
-            prompt_embeds=prompt_embeds, negative_prompt_embeds=negative_embeds, generator=generator, output_type="pt"
-        ).images
+    def _run_stage_3(self, state: Dict) -> List["Image"]:
+        with self.timer.time("stage_3"):
+            return self.stage_3(
+                prompt=state["prompts"],
+                image=state["images"],
+                generator=state["generator"],
+                noise_level=100,
+                output_type=self.output_type,
+            ).images
 
-        images = self.stage_2(
-            image=images,
-            prompt_embeds=prompt_embeds,
-            negative_prompt_embeds=negative_embeds,
-            generator=generator,
-            output_type="pt",
-        ).images
+    def _finish_draft(self, state: Dict) -> List["np.ndarray"]:
+        """
+        Caches each draft image as the [-1, 1] tensor the next stage takes, under its key in `draft_keys`.
+        """
+        images = state["images"]
+        for i, key in enumerate(state.get("draft_keys") or []):
+            self.drafts.put(
+                key,
+                {
+                    "prompt": state["prompts"][i],
+                    "image": torch.from_numpy(images[i : i + 1]).permute(0, 3, 1, 2) * 2 - 1,
+                    "stage": state["stage"],
+                    "hparams": state["hparams"],
+                    "seed": state["seeds"][i],
+                },
+            )
+        return list(images)
 
-        images = self.stage_3(prompt=prompts, image=images, generator=generator, noise_level=100).images
-        return images
+    def _stages(self, hparams: Dict) -> List:
+        stop_after = drafts.last_stage(hparams)
+        if stop_after == "stage_3":
+            return [self._run_stage_1, self._run_stage_2, self._run_stage_3]
+        stages = [self._run_stage_1, self._run_stage_2][: drafts.STAGES.index(stop_after) + 1]
+        return stages + [self._finish_draft]
+
+    def generate_images(
+        self, prompts: List[str], seeds: List[int], hparams: Dict, draft_keys: Optional[List[str]] = None
+    ) -> List["Image"]:
+        """
+        Generates prompts[i] from seeds[i], all in one batch.
+
+        With `hparams["draft"]` (or `stop_after`) set this runs fewer steps and stops before stage_3, returning
+        float arrays and caching the intermediates under `draft_keys` for upscale().
+        """
+        result = {
+            "prompts": prompts,
+            "hparams": hparams,
+            "generator": self._generators(seeds),
+            "seeds": seeds,
+            "draft_keys": draft_keys,
+        }
+        for stage in self._stages(hparams):
+            result = stage(result)
+        return result
+
+    def generate_images_pipelined(
+        self,
+        chunks: List[Tuple[List[str], List[int]]],
+        hparams: Dict,
+        queue_size: Optional[int] = 1,
+        draft_keys: Optional[List[List[str]]] = None,
+    ) -> Iterator[List["Image"]]:
+        """
+        Like calling generate_images on each (prompts, seeds) chunk, but with each stage in its own thread so
+        chunk n+1's stage_1 overlaps chunk n's stage_2/stage_3. Needs enough VRAM for all three stages' active
+        models at once, at most `queue_size` intermediate batches wait between stages.
+        """
+        states = [
+            {
+                "prompts": prompts,
+                "hparams": hparams,
+                "generator": self._generators(seeds),
+                "seeds": seeds,
+                "draft_keys": draft_keys[i] if draft_keys else None,
+            }
+            for i, (prompts, seeds) in enumerate(chunks)
+        ]
+        return staged_pipeline.run_staged(self._stages(hparams), states, queue_size=queue_size)
+
+    def upscale(self, key: str) -> List["Image"]:
+        """
+        Runs the stages a draft skipped on one cached draft image, at full quality. Raises KeyError once the
+        draft has been evicted.
+        """
+        entry = self.drafts.get(key)
+        state = {
+            "prompts": [entry["prompt"]],
+            "hparams": drafts.full_quality(entry["hparams"]),
+            "generator": self._generators([entry["seed"]]),
+            "images": entry["image"].to(self.stage_1._execution_device, torch.float16),
+        }
+        try:
+            if entry["stage"] == "stage_1":
+                state["prompt_embeds"], state["negative_embeds"] = self.encode_prompts(
+                    state["prompts"], state["hparams"].get("negative_prompt")
+                )
+                state = self._run_stage_2(state)
+            return self._run_stage_3(state)
+        finally:
+            state = None
+            self.release_memory()
 
     def generate_images_from_image(
-        self, prompts: List[str], original_images: List["Image"], seed: int, hparams: Dict
+        self, prompts: List[str], original_images: List["Image"], seeds: List[int], hparams: Dict
     ) -> List["Image"]:
-        generator = torch.manual_seed(seed)
-        prompt_embeds, negative_embeds = self.stage_1_img2img.encode_prompt(prompts)
+        generator = self._generators(seeds)
+        prompt_embeds, negative_embeds = self.encode_prompts(prompts, hparams.get("negative_prompt"))
 
         strength = hparams.get("strength")
 
-        images = self.stage_1_img2img(
-            image=original_images,
-            prompt_embeds=prompt_embeds,
-            negative_prompt_embeds=negative_embeds,
-            generator=generator,
-            output_type="pt",
-            strength=strength,
-        ).images
-
-        images = self.stage_2_img2img(
-            image=images,
-            original_image=original_images,
-            prompt_embeds=prompt_embeds,
-            negative_prompt_embeds=negative_embeds,
-            generator=generator,
-            output_type="pt",
-            strength=strength,
-        ).images
-
-        images = self.stage_3(prompt=prompts, image=images, generator=generator, noise_level=100).images
-
-        return images
+        try:
+            with self.timer.time("stage_1"):
+                images = self.stage_1_img2img(
+                    image=original_images,
+                    prompt_embeds=prompt_embeds,
+                    negative_prompt_embeds=negative_embeds,
+                    generator=generator,
+                    output_type="pt",
+                    strength=strength,
+                ).images
+
+            with self.timer.time("stage_2"):
+                images = self.stage_2_img2img(
+                    image=images,
+                    original_image=original_images,
+                    prompt_embeds=prompt_embeds,
+                    negative_prompt_embeds=negative_embeds,
+                    generator=generator,
+                    output_type="pt",
+                    strength=strength,
+                ).images
+
+            with self.timer.time("stage_3"):
+                return self.stage_3(
+                    prompt=prompts, image=images, generator=generator, noise_level=100, output_type=self.output_type
+                ).images
+        finally:
+            # drop intermediates before the next chunk instead of reloading the pipelines
+            del prompt_embeds, negative_embeds
+            images = None
+            self.release_memory()
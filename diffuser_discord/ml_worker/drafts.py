@@ -0,0 +1,46 @@
+from typing import Dict, Optional, Any
+from collections import OrderedDict
+
+STAGES = ["stage_1", "stage_2", "stage_3"]
+# denoising steps per stage in draft mode, the IF defaults are 100 and 50
+DRAFT_STEPS = {"stage_1": 30, "stage_2": 20}
+DRAFT_HPARAMS = ["draft", "stop_after", "stage_1_steps", "stage_2_steps"]
+
+
+def last_stage(hparams: Dict) -> str:
+    """
+    The stage a request stops after: `stop_after` if given, stage_2 for drafts and stage_3 otherwise.
+    """
+    return hparams.get("stop_after") or ("stage_2" if hparams.get("draft") else "stage_3")
+
+
+def stage_steps(hparams: Dict, stage: str) -> Optional[int]:
+    return hparams.get(f"{stage}_steps") or (DRAFT_STEPS.get(stage) if hparams.get("draft") else None)
+
+
+def full_quality(hparams: Dict) -> Dict:
+    return {key: value for key, value in hparams.items() if key not in DRAFT_HPARAMS}
+
+
+class IntermediateCache:
+    """
+    LRU of draft intermediates (the last stage's output per image, plus what's needed to run the remaining
+    stages), so upscaling a draft doesn't repeat the stages already run.
+    """
+
+    def __init__(self, max_entries: Optional[int] = 256):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def put(self, key: str, entry: Dict[str, Any]):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key: str) -> Dict[str, Any]:
+        entry = self.entries.get(key)
+        if entry is None:
+            raise KeyError(f"Draft {key} is no longer cached")
+        self.entries.move_to_end(key)
+        return entry
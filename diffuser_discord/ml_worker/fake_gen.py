@@ -0,0 +1,201 @@
+from typing import List, Dict, Tuple, Iterator, Optional
+import threading
+import hashlib
+import logging
+import time
+
+from PIL import Image
+
+from diffuser_discord.ml_worker import staged_pipeline, drafts, memory_profiles
+from diffuser_discord.ml_worker.timing import StageTimer
+
+GB = 1024**3
+
+# share of `seconds_per_image` spent in each stage, roughly DeepFloyd's split on an A10G
+STAGE_SHARES = {"encode_prompts": 0.05, "stage_1": 0.35, "stage_2": 0.3, "stage_3": 0.3}
+# simulated activation memory per image in flight in each stage
+STAGE_MEMORY = {"stage_1": 1 * GB, "stage_2": 2 * GB, "stage_3": 3 * GB}
+# output side relative to stage_3's, IF goes 64 -> 256 -> 1024
+STAGE_SCALE = {"stage_1": 16, "stage_2": 4, "stage_3": 1}
+# denoising steps the stage costs assume
+FULL_STEPS = {"stage_1": 100, "stage_2": 50}
+# placement -> (share of the weights resident on the GPU, stage time multiplier)
+PLACEMENT_COSTS = {"gpu": (1.0, 1.0), "model_offload": (0.45, 1.2), "sequential_offload": (0.05, 3.0)}
+# attention slicing and VAE tiling -> (activation memory multiplier, stage time multiplier)
+SLICING_COSTS = (0.6, 1.1)
+TILING_COSTS = (0.5, 1.05)
+
+
+class FakeDeepFloydIF:
+    """
+    Deterministic CPU stand-in for DeepFloydIF with the same interface, returning solid colour images derived from
+    each image's (prompt, seed).
+
+    Each stage sleeps `overhead + per_image * n` for a batch of n. With `memory_limit` set, a stage whose batch
+    would push simulated memory (weights plus every stage's activations in flight) past the limit raises an out
+    of memory error the way torch would, so batch sizing and pipelining behave like they do on a GPU.
+    `memory_profile` scales resident weights, activations and stage times roughly like the real profiles do, with
+    `memory_limit` as the card size for "auto".
+    """
+
+    def __init__(
+        self,
+        seconds_per_image: float = 0.5,
+        image_size: int = 256,
+        stage_costs: Optional[Dict[str, Tuple[float, float]]] = None,
+        memory_limit: Optional[int] = None,
+        weights_memory: Optional[int] = 8 * GB,
+        stage_memory: Optional[Dict[str, int]] = None,
+        memory_profile: Optional[str] = None,
+    ):
+        self.seconds_per_image = seconds_per_image
+        self.image_size = image_size
+        # stage -> (overhead seconds, seconds per image)
+        self.stage_costs = stage_costs or {
+            stage: (0.0, share * seconds_per_image) for stage, share in STAGE_SHARES.items()
+        }
+        self.memory_limit = memory_limit
+        self.profile_name, self.profile = memory_profiles.resolve(memory_profile, memory_limit)
+        resident, self.time_scale = PLACEMENT_COSTS[self.profile.placement]
+        self.weights_memory = int(weights_memory * resident)
+        self.stage_memory = dict(stage_memory or STAGE_MEMORY)
+        self.stage_time_scale = {stage: self.time_scale for stage in STAGE_SHARES}
+        if self.profile.attention_slicing:
+            for stage in self.stage_memory:
+                self.stage_memory[stage] = int(self.stage_memory[stage] * SLICING_COSTS[0])
+                self.stage_time_scale[stage] *= SLICING_COSTS[1]
+        if self.profile.vae_tiling:
+            self.stage_memory["stage_3"] = int(self.stage_memory["stage_3"] * TILING_COSTS[0])
+            self.stage_time_scale["stage_3"] *= TILING_COSTS[1]
+        self.lock = threading.Lock()
+        self.active_memory = 0
+        self.peak_memory = 0
+        self.reload_count = 0
+        self.load_times: Dict[str, float] = {}
+        self.timer = StageTimer()
+        self.drafts = drafts.IntermediateCache()
+
+    def load_weights(self):
+        start = time.time()
+        time.sleep(0.1)
+        self.load_times["fake"] = time.time() - start
+        logging.info(f"Loaded weights with the {self.profile_name} memory profile {self.load_times}")
+
+    def reload_weights(self):
+        self.load_weights()
+        self.reload_count += 1
+
+    def release_memory(self):
+        pass
+
+    def pop_peak_memory(self) -> Optional[int]:
+        with self.lock:
+            peak, self.peak_memory = self.peak_memory, 0
+        return peak
+
+    def warmup(self) -> float:
+        start = time.time()
+        self.generate_images(["warmup"], seeds=[0], hparams={})
+        return time.time() - start
+
+    def _run_stage(self, stage: str, n: int, hparams: Optional[Dict] = None):
+        size = n * self.stage_memory.get(stage, 0)
+        with self.lock:
+            in_use = self.weights_memory + self.active_memory + size
+            if self.memory_limit is not None and in_use > self.memory_limit:
+                raise RuntimeError(f"CUDA out of memory (simulated) in {stage} with a batch of {n}")
+            self.active_memory += size
+            self.peak_memory = max(self.peak_memory, in_use)
+        try:
+            overhead, per_image = self.stage_costs.get(stage, (0.0, 0.0))
+            steps = drafts.stage_steps(hparams or {}, stage)
+            if steps is not None and stage in FULL_STEPS:
+                per_image *= steps / FULL_STEPS[stage]
+            with self.timer.time(stage):
+                time.sleep((overhead + per_image * n) * self.stage_time_scale.get(stage, 1.0))
+        finally:
+            with self.lock:
+                self.active_memory -= size
+
+    def _run_stage_1(self, state: Dict) -> Dict:
+        self._run_stage("encode_prompts", len(set(state["prompts"])))
+        self._run_stage("stage_1", len(state["prompts"]), state["hparams"])
+        state["stage"] = "stage_1"
+        return state
+
+    def _run_stage_2(self, state: Dict) -> Dict:
+        self._run_stage("stage_2", len(state["prompts"]), state["hparams"])
+        state["stage"] = "stage_2"
+        return state
+
+    def _run_stage_3(self, state: Dict) -> List["Image"]:
+        self._run_stage("stage_3", len(state["prompts"]))
+        return [self._image(prompt, seed) for prompt, seed in zip(state["prompts"], state["seeds"])]
+
+    def _finish_draft(self, state: Dict) -> List["Image"]:
+        for i, key in enumerate(state.get("draft_keys") or []):
+            self.drafts.put(
+                key,
+                {
+                    "prompt": state["prompts"][i],
+                    "seed": state["seeds"][i],
+                    "stage": state["stage"],
+                    "hparams": state["hparams"],
+                },
+            )
+        size = self.image_size // STAGE_SCALE[state["stage"]]
+        return [self._image(prompt, seed, size) for prompt, seed in zip(state["prompts"], state["seeds"])]
+
+    def _image(self, prompt: str, seed: int, size: Optional[int] = None) -> "Image":
+        digest = hashlib.sha256(f"{prompt}:{seed}".encode()).digest()
+        size = size or self.image_size
+        return Image.new("RGB", (size, size), tuple(digest[:3]))
+
+    def _stages(self, hparams: Dict) -> List:
+        stop_after = drafts.last_stage(hparams)
+        if stop_after == "stage_3":
+            return [self._run_stage_1, self._run_stage_2, self._run_stage_3]
+        stages = [self._run_stage_1, self._run_stage_2][: drafts.STAGES.index(stop_after) + 1]
+        return stages + [self._finish_draft]
+
+    def generate_images(
+        self, prompts: List[str], seeds: List[int], hparams: Dict, draft_keys: Optional[List[str]] = None
+    ) -> List["Image"]:
+        result = {"prompts": prompts, "seeds": seeds, "hparams": hparams, "draft_keys": draft_keys}
+        for stage in self._stages(hparams):
+            result = stage(result)
+        return result
+
+    def generate_images_pipelined(
+        self,
+        chunks: List[Tuple[List[str], List[int]]],
+        hparams: Dict,
+        queue_size: Optional[int] = 1,
+        draft_keys: Optional[List[List[str]]] = None,
+    ) -> Iterator[List["Image"]]:
+        states = [
+            {
+                "prompts": prompts,
+                "seeds": seeds,
+                "hparams": hparams,
+                "draft_keys": draft_keys[i] if draft_keys else None,
+            }
+            for i, (prompts, seeds) in enumerate(chunks)
+        ]
+        return staged_pipeline.run_staged(self._stages(hparams), states, queue_size=queue_size)
+
+    def upscale(self, key: str) -> List["Image"]:
+        entry = self.drafts.get(key)
+        state = {
+            "prompts": [entry["prompt"]],
+            "seeds": [entry["seed"]],
+            "hparams": drafts.full_quality(entry["hparams"]),
+        }
+        if entry["stage"] == "stage_1":
+            state = self._run_stage_2(state)
+        return self._run_stage_3(state)
+
+    def generate_images_from_image(
+        self, prompts: List[str], original_images: List["Image"], seeds: List[int], hparams: Dict
+    ) -> List["Image"]:
+        return self.generate_images(prompts, seeds, hparams)
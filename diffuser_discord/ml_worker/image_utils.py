@@ -1,6 +1,6 @@
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, Union, NamedTuple
 from PIL import Image
-import requests
+import numpy as np
 import math
 import io
 
@@ -28,12 +28,82 @@ def image_grid(imgs: List["Image"], shape: Optional[Tuple] = None) -> "Image":
     return grid
 
 
-def image_from_url(url: str) -> "Image":
-    try:
-        resp = requests.get(url)
-    except:
-        # basic retry
-        resp = requests.get(url)
-    img = Image.open(io.BytesIO(resp.content))
-    img = img.convert("RGB")
-    return img
+def to_uint8_array(imgs: Union[List, np.ndarray]) -> np.ndarray:
+    """
+    Stacks PIL images or float [0, 1] HWC arrays into one (N, H, W, C) uint8 batch, converting in a single pass.
+    """
+    if isinstance(imgs, list) and isinstance(imgs[0], Image.Image):
+        return np.stack([np.asarray(img.convert("RGB")) for img in imgs])
+    batch = np.stack(imgs) if isinstance(imgs, list) else imgs
+    if batch.dtype != np.uint8:
+        batch = np.multiply(batch, 255, dtype=np.float32)
+        np.clip(batch, 0, 255, out=batch)
+        np.rint(batch, out=batch)
+        batch = batch.astype(np.uint8)
+    return batch
+
+
+def array_grid(imgs: Union[List, np.ndarray], shape: Optional[Tuple] = None) -> np.ndarray:
+    """
+    Vectorized image_grid, writing the whole batch into one preallocated array instead of pasting per image.
+    """
+    batch = to_uint8_array(imgs)
+    n, h, w, c = batch.shape
+    if shape is not None:
+        cols, rows = shape
+    else:
+        cols, rows = _get_grid_shape(n)
+
+    grid = np.zeros((rows, h, cols, w, c), dtype=np.uint8)
+    cells = grid.transpose(0, 2, 1, 3, 4)
+    full_rows = n // cols
+    cells[:full_rows] = batch[: full_rows * cols].reshape(full_rows, cols, h, w, c)
+    if n > full_rows * cols:
+        cells[full_rows, : n - full_rows * cols] = batch[full_rows * cols :]
+    return grid.reshape(rows * h, cols * w, c)
+
+
+class EncodeSettings(NamedTuple):
+    format: str
+    quality: Optional[int] = None
+    max_side: Optional[int] = None
+
+    @property
+    def extension(self) -> str:
+        return "jpg" if self.format == "JPEG" else self.format.lower()
+
+
+PREVIEW_ENCODING = EncodeSettings("WEBP", quality=80, max_side=1024)
+FULL_ENCODING = EncodeSettings("PNG")
+
+
+def thumbnail(grid: np.ndarray, max_side: int) -> np.ndarray:
+    h, w = grid.shape[:2]
+    if max(h, w) <= max_side:
+        return grid
+    img = Image.fromarray(grid)
+    img.thumbnail((max_side, max_side))
+    return np.asarray(img)
+
+
+def encode_image(grid: np.ndarray, settings: EncodeSettings) -> bytes:
+    if settings.max_side is not None:
+        grid = thumbnail(grid, settings.max_side)
+    kwargs = {} if settings.quality is None else {"quality": settings.quality}
+    return image_to_bytes(Image.fromarray(grid), format=settings.format, **kwargs)
+
+
+def image_to_bytes(img: "Image", format: Optional[str] = "PNG", **kwargs) -> bytes:
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format=format, **kwargs)
+    return img_bytes.getvalue()
+
+
+def decode_image(data: bytes, size: Optional[Tuple[int, int]] = (512, 512)) -> np.ndarray:
+    """
+    Decodes and resizes a source image into the (H, W, 3) uint8 buffer the img2img pipelines start from.
+    """
+    img = Image.open(io.BytesIO(data))
+    img.draft("RGB", size)
+    img = img.convert("RGB").resize(size)
+    return np.asarray(img)
@@ -7,14 +7,12 @@ import os
 IMGUR_CLIENT_ID = os.environ.get("IMGUR_CLIENT_ID", "")
 
 
-def upload_to_imgur(pil_image) -> str:
-    img_bytes = io.BytesIO()
-    pil_image.save(img_bytes, format="PNG")
+def upload_bytes_to_imgur(image_bytes: bytes) -> str:
     resp = requests.post(
         "https://api.imgur.com/3/image",
         headers={"Authorization": f"Client-ID {IMGUR_CLIENT_ID}"},
         data={
-            "image": base64.b64encode(img_bytes.getvalue()),
+            "image": base64.b64encode(image_bytes),
             "type": "base64",
             "name": "img",
             "title": "img",
@@ -22,3 +20,9 @@ def upload_to_imgur(pil_image) -> str:
     ).json()
     logging.info("Imgur upload " + repr(resp))
     return resp["data"]["link"]
+
+
+def upload_to_imgur(pil_image) -> str:
+    img_bytes = io.BytesIO()
+    pil_image.save(img_bytes, format="PNG")
+    return upload_bytes_to_imgur(img_bytes.getvalue())
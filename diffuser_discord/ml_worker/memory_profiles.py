@@ -0,0 +1,39 @@
+from typing import Optional, Tuple, NamedTuple
+
+GB = 1024**3
+
+
+class MemoryProfile(NamedTuple):
+    # "gpu" keeps every model resident, "model_offload" moves whole models on and off the GPU as they run and
+    # "sequential_offload" streams submodules, trading most of the speed for the smallest footprint
+    placement: str
+    attention_slicing: bool = False
+    vae_tiling: bool = False
+    # smallest card "auto" picks this profile for
+    min_vram: int = 0
+
+
+PROFILES = {
+    "max_speed": MemoryProfile("gpu", min_vram=40 * GB),
+    "balanced": MemoryProfile("model_offload", min_vram=16 * GB),
+    "low_vram": MemoryProfile("sequential_offload", attention_slicing=True, vae_tiling=True),
+}
+DEFAULT_PROFILE = "balanced"
+
+
+def resolve(name: Optional[str], total_vram: Optional[int] = None) -> Tuple[str, MemoryProfile]:
+    """
+    Looks up a profile by name. "auto" picks the fastest profile whose `min_vram` the card meets, or the
+    default when the card's memory is unknown.
+    """
+    name = name or DEFAULT_PROFILE
+    if name != "auto":
+        if name not in PROFILES:
+            raise ValueError(f"Unknown memory profile {name}, expected auto or one of {list(PROFILES)}")
+        return name, PROFILES[name]
+    if total_vram is None:
+        return DEFAULT_PROFILE, PROFILES[DEFAULT_PROFILE]
+    for name, profile in sorted(PROFILES.items(), key=lambda item: -item[1].min_vram):
+        if total_vram >= profile.min_vram:
+            return name, profile
+    return DEFAULT_PROFILE, PROFILES[DEFAULT_PROFILE]
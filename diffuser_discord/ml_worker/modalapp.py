@@ -1,7 +1,11 @@
 import modal
-import asyncio
 
 CACHE_DIR = "/root/cache"
+# prompts per Model.inference call, bounded by what base + refiner fit in an A10G's memory at once
+BATCH_SIZE = 4
+# how the final latents are decoded: "batched" in one VAE call, "sliced" one image at a time or "tiled" in
+# overlapping tiles, the latter two bound decode memory for large batches at some speed cost
+VAE_MODE = "batched"
 
 
 def download_models():
@@ -46,35 +50,81 @@ class Model:
             **load_options,
         )
 
-    @modal.method()
-    def inference(self, prompt, seed, steps, high_noise_frac, negative_prompt):
+    def _decode(self, latents, vae_mode):
+        """
+        Decodes a batch of latents with the shared VAE in one call, upcasting it like the pipelines do since the
+        SDXL VAE overflows in fp16.
+        """
         import torch
 
-        generator = torch.manual_seed(seed)
-        image = self.base(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            num_inference_steps=steps,
-            denoising_end=high_noise_frac,
-            output_type="latent",
-            generator=generator,
-        ).images
-        image = self.refiner(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            num_inference_steps=steps,
-            denoising_start=high_noise_frac,
-            image=image,
-            generator=generator,
-        ).images[0]
-
-        import io
+        vae = self.base.vae
+        if vae_mode == "sliced":
+            vae.enable_slicing()
+        else:
+            vae.disable_slicing()
+        if vae_mode == "tiled":
+            vae.enable_tiling()
+        else:
+            vae.disable_tiling()
+        upcast = vae.dtype == torch.float16 and vae.config.force_upcast
+        # the denoising activations are gone by now, hand their memory to the decode
+        torch.cuda.empty_cache()
+        if upcast:
+            vae.to(torch.float32)
+        try:
+            with torch.no_grad():
+                images = vae.decode(latents.to(vae.dtype) / vae.config.scaling_factor, return_dict=False)[0]
+        finally:
+            if upcast:
+                vae.to(torch.float16)
+        watermark = getattr(self.refiner, "watermark", None)
+        if watermark is not None:
+            images = watermark.apply_watermark(images)
+        images = (images / 2 + 0.5).clamp(0, 1).mul(255).round().to(torch.uint8)
+        return images.permute(0, 2, 3, 1).cpu().numpy()
 
-        byte_stream = io.BytesIO()
-        image.save(byte_stream, format="PNG")
-        image_bytes = byte_stream.getvalue()
+    @modal.method()
+    def inference(self, prompts, seeds, steps, high_noise_frac, negative_prompt, refine=True, vae_mode=VAE_MODE):
+        """
+        Generates prompts[i] from seeds[i] for the whole list in one batch and returns the images as a uint8
+        (N, H, W, C) array, leaving encoding to the caller. Each image has its own generator so it can be
+        reproduced on its own.
+
+        Base and refiner hand off latents and neither decodes, the VAE runs once on the final latents.
+        """
+        import torch
 
-        return image_bytes
+        negative_prompts = [negative_prompt] * len(prompts)
+        generator = [torch.Generator().manual_seed(seed) for seed in seeds]
+        if not refine:
+            # drafts skip the refiner and let the base model run all the steps
+            latents = self.base(
+                prompt=prompts,
+                negative_prompt=negative_prompts,
+                num_inference_steps=steps,
+                generator=generator,
+                output_type="latent",
+            ).images
+        else:
+            latents = self.base(
+                prompt=prompts,
+                negative_prompt=negative_prompts,
+                num_inference_steps=steps,
+                denoising_end=high_noise_frac,
+                output_type="latent",
+                generator=generator,
+            ).images
+            latents = self.refiner(
+                prompt=prompts,
+                negative_prompt=negative_prompts,
+                num_inference_steps=steps,
+                denoising_start=high_noise_frac,
+                image=latents,
+                generator=generator,
+                output_type="latent",
+            ).images
+
+        return self._decode(latents, vae_mode)
 
 
 @stub.function(
@@ -89,23 +139,41 @@ class Model:
         modal.Secret.from_name("imgur-secret"),
     ],
 )
-async def generate_images(prompts, seed=0, steps=30, high_noise_frac=0.8, negative_prompt="disfigured, ugly, deformed"):
-    import io
-    from PIL import Image
+async def generate_images(
+    prompts,
+    seed=0,
+    steps=30,
+    high_noise_frac=0.8,
+    negative_prompt="disfigured, ugly, deformed",
+    refine=True,
+    batch_size=BATCH_SIZE,
+    vae_mode=VAE_MODE,
+):
+    import numpy as np
     from diffuser_discord.ml_worker import imgur_utils, image_utils
 
     modal_model = Model()
 
-    images = []
-    for partial_result in modal_model.inference.starmap(
-        [(prompt, seed + i) for i, prompt in enumerate(prompts)],
-        kwargs=dict(steps=steps, high_noise_frac=high_noise_frac, negative_prompt=negative_prompt),
+    # image i is generated from seed + i, so results don't depend on how the prompts are split into batches
+    calls = [
+        (prompts[i : i + batch_size], [seed + i + j for j in range(len(prompts[i : i + batch_size]))])
+        for i in range(0, len(prompts), batch_size)
+    ]
+    batches = []
+    async for batch in modal_model.inference.starmap.aio(
+        calls,
+        kwargs=dict(
+            steps=steps,
+            high_noise_frac=high_noise_frac,
+            negative_prompt=negative_prompt,
+            refine=refine,
+            vae_mode=vae_mode,
+        ),
     ):
-        await asyncio.sleep(0.5)
-        images.append(Image.open(io.BytesIO(partial_result)))
+        batches.append(batch)
 
-    img = image_utils.image_grid(images)
-    return imgur_utils.upload_to_imgur(img)
+    grid = image_utils.array_grid(np.concatenate(batches))
+    return imgur_utils.upload_bytes_to_imgur(image_utils.encode_image(grid, image_utils.FULL_ENCODING))
 
 
 @stub.local_entrypoint()
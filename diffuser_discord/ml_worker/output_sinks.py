@@ -0,0 +1,50 @@
+from abc import ABC, abstractmethod
+import hashlib
+import uuid
+import os
+
+
+class OutputSink(ABC):
+    # uploads count against a quota and block on a remote API, so callers should save as few variants as they can
+    metered = False
+
+    @abstractmethod
+    def save(self, image_bytes: bytes, extension: str = "png") -> str:
+        """
+        Stores encoded image bytes and returns a URL Discord can embed.
+        """
+        pass
+
+
+class ImgurSink(OutputSink):
+    metered = True
+
+    def save(self, image_bytes: bytes, extension: str = "png") -> str:
+        from diffuser_discord.ml_worker import imgur_utils
+
+        return imgur_utils.upload_bytes_to_imgur(image_bytes)
+
+
+class LocalFileSink(OutputSink):
+    """
+    Content-addressed store, files are named by the sha256 of their bytes so identical outputs are written once.
+    """
+
+    def __init__(self, root_dir: str, base_url: str):
+        self.root_dir = root_dir
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def path_for(self, name: str) -> str:
+        return os.path.join(self.root_dir, name)
+
+    def save(self, image_bytes: bytes, extension: str = "png") -> str:
+        name = f"{hashlib.sha256(image_bytes).hexdigest()}.{extension}"
+        path = self.path_for(name)
+        if not os.path.exists(path):
+            # unique per save, concurrent saves of the same image would otherwise share it
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(image_bytes)
+            os.replace(tmp_path, path)
+        return f"{self.base_url}/{name}"
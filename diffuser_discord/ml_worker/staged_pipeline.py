@@ -0,0 +1,80 @@
+from typing import Any, Callable, Iterator, List
+import threading
+import queue
+
+_DONE = object()
+
+
+class _StageError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _put(q: "queue.Queue", item: Any, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q: "queue.Queue", stop: threading.Event) -> Any:
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def _run_stage(stage: Callable[[Any], Any], inbox: "queue.Queue", outbox: "queue.Queue", stop: threading.Event):
+    while True:
+        item = _get(inbox, stop)
+        if item is _DONE or isinstance(item, _StageError):
+            _put(outbox, item, stop)
+            return
+        try:
+            result = stage(item)
+        except BaseException as e:
+            _put(outbox, _StageError(e), stop)
+            return
+        if not _put(outbox, result, stop):
+            return
+
+
+def run_staged(stages: List[Callable[[Any], Any]], items: List[Any], queue_size: int = 1) -> Iterator[Any]:
+    """
+    Runs every item through `stages` in order with one thread per stage, so item n+1's first stage overlaps
+    item n's later stages. Queues between stages hold at most `queue_size` items to bound memory. Yields
+    results in input order and re-raises the first stage error.
+    """
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    threads = [
+        threading.Thread(target=_run_stage, args=(stage, queues[i], queues[i + 1], stop), daemon=True)
+        for i, stage in enumerate(stages)
+    ]
+
+    def feed():
+        for item in items:
+            if not _put(queues[0], item, stop):
+                return
+        _put(queues[0], _DONE, stop)
+
+    threads.append(threading.Thread(target=feed, daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            result = queues[-1].get()
+            if result is _DONE:
+                return
+            if isinstance(result, _StageError):
+                raise result.error
+            yield result
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,47 @@
+from typing import Dict, Optional
+from contextlib import contextmanager
+import threading
+import time
+
+
+class StageTimer:
+    """
+    Accumulates wall time per named stage until popped. Stages running in parallel threads each add their own
+    time, so with pipelining the totals can exceed the wall time of the request.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals: Dict[str, float] = {}
+
+    @contextmanager
+    def time(self, name: str):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name: str, seconds: float):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def pop(self) -> Dict[str, float]:
+        with self.lock:
+            totals, self.totals = self.totals, {}
+        return totals
+
+
+def gpu_peak_bytes(reset: Optional[bool] = True) -> Optional[int]:
+    """
+    Peak CUDA memory allocated since the last reset, or None when torch/CUDA isn't in use in this process.
+    """
+    import sys
+
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+    peak = torch.cuda.max_memory_allocated()
+    if reset:
+        torch.cuda.reset_peak_memory_stats()
+    return peak
@@ -0,0 +1,43 @@
+import timeit
+
+import numpy as np
+
+from diffuser_discord.ml_worker import image_utils
+from diffuser_discord.ml_worker.image_utils import EncodeSettings
+
+
+SETTINGS = {
+    "png": EncodeSettings("PNG"),
+    "webp q70": EncodeSettings("WEBP", quality=70),
+    "webp q80": EncodeSettings("WEBP", quality=80),
+    "webp q90": EncodeSettings("WEBP", quality=90),
+    "jpeg q80": EncodeSettings("JPEG", quality=80),
+    "jpeg q90": EncodeSettings("JPEG", quality=90),
+    "preview": image_utils.PREVIEW_ENCODING,
+}
+
+
+def _synthetic_grid(n: int, size: int = 1024) -> np.ndarray:
+    # smooth gradients plus noise, closer to generated images than pure noise (which no codec compresses)
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:size, 0:size] / size
+    images = []
+    for i in range(n):
+        base = np.stack([np.sin(x * (i + 2)), np.cos(y * (i + 3)), x * y], axis=-1) * 0.5 + 0.5
+        images.append(np.clip(base + rng.normal(0, 0.03, base.shape), 0, 1).astype(np.float32))
+    return image_utils.array_grid(images)
+
+
+def main():
+    print(f"{'grid':>6} {'settings':>10} {'encode ms':>10} {'KiB':>10}")
+    for n in [1, 4, 9]:
+        grid = _synthetic_grid(n)
+        for name, settings in SETTINGS.items():
+            number = 3
+            ms = timeit.timeit(lambda: image_utils.encode_image(grid, settings), number=number) / number * 1000
+            size = len(image_utils.encode_image(grid, settings)) / 1024
+            print(f"{n:>6} {name:>10} {ms:>10.1f} {size:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
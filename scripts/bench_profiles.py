@@ -0,0 +1,88 @@
+"""
+Loads DeepFloyd with each memory profile in a fresh worker process and reports load time, per-stage latency and
+peak GPU memory, to pick the fastest profile that fits a card. BACKEND=fake runs the simulated backend on CPU,
+with MEMORY_LIMIT_GB standing in for the card size.
+"""
+
+from typing import Dict, List
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import logging
+import time
+import os
+
+from diffuser_discord.bot import image_client
+from diffuser_discord.ml_worker import memory_profiles, batch_sizing, fake_gen
+
+BACKEND = os.environ.get("BACKEND", "deepfloyd")
+DEVICE = os.environ.get("DEVICE", "cuda:0")
+PROFILES = os.environ.get("PROFILES", ",".join(memory_profiles.PROFILES)).split(",")
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "4"))
+RUNS = int(os.environ.get("RUNS", "3"))
+MEMORY_LIMIT_GB = os.environ.get("MEMORY_LIMIT_GB", None)
+PROMPT = "an oil painting of a spiral galaxy"
+
+
+def measure(profile: str) -> Dict:
+    """
+    Runs in the worker process, after _local_init loaded the weights with `profile`.
+    """
+    deep_floyd = image_client.deep_floyd
+    result = {"profile": deep_floyd.profile_name, "load": sum(deep_floyd.load_times.values()), "runs": []}
+    deep_floyd.timer.pop()
+    deep_floyd.pop_peak_memory()
+    try:
+        for run in range(RUNS + 1):
+            start = time.time()
+            deep_floyd.generate_images([PROMPT] * BATCH_SIZE, list(range(BATCH_SIZE)), {})
+            # the first run compiles kernels and warms the offload hooks, it's reported separately
+            result["runs"].append({"total": time.time() - start, **deep_floyd.timer.pop()})
+    except Exception as e:
+        if not batch_sizing.is_oom_error(e):
+            raise
+        result["error"] = "OOM"
+    result["peak"] = deep_floyd.pop_peak_memory()
+    return result
+
+
+def run_profile(profile: str) -> Dict:
+    backend_options = {}
+    if BACKEND == "fake" and MEMORY_LIMIT_GB is not None:
+        backend_options["memory_limit"] = int(float(MEMORY_LIMIT_GB) * fake_gen.GB)
+    with ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=image_client._local_init,
+        initargs=(DEVICE, BACKEND, backend_options, None, False, None, profile),
+    ) as executor:
+        return executor.submit(measure, profile).result()
+
+
+def report(results: List[Dict]):
+    stages = ["encode_prompts", "stage_1", "stage_2", "stage_3"]
+    print(f"{'profile':>12} {'load':>7} {'first':>7} {'mean':>7} " + " ".join(f"{s:>14}" for s in stages) + "  peak GB")
+    for result in results:
+        runs = result["runs"][1:]
+        if "error" in result or not runs:
+            print(f"{result['profile']:>12} {result['load']:>7.1f} {result.get('error', 'no runs'):>7}")
+            continue
+        mean = {key: sum(run.get(key, 0.0) for run in runs) / len(runs) for key in ["total"] + stages}
+        peak = "n/a" if result["peak"] is None else f"{result['peak'] / fake_gen.GB:.1f}"
+        print(
+            f"{result['profile']:>12} {result['load']:>7.1f} {result['runs'][0]['total']:>7.2f} {mean['total']:>7.2f} "
+            + " ".join(f"{mean[s]:>14.2f}" for s in stages)
+            + f"  {peak}"
+        )
+    fits = [result for result in results if "error" not in result and len(result["runs"]) > 1]
+    if fits:
+        best = min(fits, key=lambda result: sum(run["total"] for run in result["runs"][1:]))
+        print(f"fastest profile that fits: {best['profile']}")
+
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    report([run_profile(profile) for profile in PROFILES])
+
+
+if __name__ == "__main__":
+    main()
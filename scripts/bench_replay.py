@@ -0,0 +1,225 @@
+"""
+Replays a recorded request stream (see REQUEST_LOG in discord_bot.py) against a LocalGPUClient running the fake
+DeepFloyd backend on CPU, going through the same fair queue, result cache and batching as the bot.
+
+Workload lines are {"t", "user", "guild", "kind", "prompt", "count", "seed", "page", ...}, with `image_url` for
+img2img. URLs of the form "source:<name>" are served as generated images from a local HTTP server.
+"""
+
+from typing import List, Dict, Optional
+import tempfile
+import zlib
+import asyncio
+import logging
+import json
+import time
+import os
+
+import numpy as np
+
+from diffuser_discord.bot import image_client, result_cache, http_server, metrics, routing_client
+from diffuser_discord.bot.fair_queue import FairScheduler
+from diffuser_discord.bot.templates import PromptTemplate
+from diffuser_discord.ml_worker.output_sinks import OutputSink
+from diffuser_discord.ml_worker import fake_gen, image_utils
+
+WORKLOAD = os.environ.get("WORKLOAD", os.path.join(os.path.dirname(__file__), "workloads", "sample.jsonl"))
+SPEEDUP = float(os.environ.get("SPEEDUP", "4"))
+DEVICES = os.environ.get("DEVICES", "cpu").split(",")
+WORKERS_PER_DEVICE = int(os.environ.get("WORKERS_PER_DEVICE", "1"))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "4"))
+BATCH_WAIT = float(os.environ.get("BATCH_WAIT", "0.05"))
+PIPELINE_STAGES = os.environ.get("PIPELINE_STAGES", "0") == "1"
+RESULT_CACHE = os.environ.get("RESULT_CACHE", "1") == "1"
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "2"))
+MAX_JOBS_PER_USER = int(os.environ.get("MAX_JOBS_PER_USER", "1"))
+MAX_PROMPTS = int(os.environ.get("MAX_PROMPTS", "16"))
+SECONDS_PER_IMAGE = float(os.environ.get("SECONDS_PER_IMAGE", "0.2"))
+MEMORY_LIMIT_GB = os.environ.get("MEMORY_LIMIT_GB", None)
+HTTP_PORT = int(os.environ.get("HTTP_PORT", "8099"))
+# devices of a second fake pool standing in for Modal, requests spill over to it past SPILLOVER_LATENCY
+SPILLOVER_DEVICES = os.environ.get("SPILLOVER_DEVICES", None)
+SPILLOVER_LATENCY = float(os.environ.get("SPILLOVER_LATENCY", "5"))
+SAMPLE_INTERVAL = 0.1
+
+
+class NullSink(OutputSink):
+    def save(self, image_bytes: bytes, extension: str = "png") -> str:
+        return f"bench://{len(image_bytes)}.{extension}"
+
+
+def load_workload(path: str) -> List[Dict]:
+    with open(path) as f:
+        requests = [json.loads(line) for line in f if line.strip()]
+    start = min(request["t"] for request in requests)
+    return sorted(({**request, "t": request["t"] - start} for request in requests), key=lambda r: r["t"])
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def write_sources(requests: List[Dict], root_dir: str):
+    for name in {r["image_url"].split(":", 1)[1] for r in requests if r.get("image_url", "").startswith("source:")}:
+        rng = np.random.default_rng(zlib.crc32(name.encode()))
+        pixels = rng.integers(0, 255, size=(768, 768, 3), dtype=np.uint8)
+        with open(os.path.join(root_dir, f"{name}.png"), "wb") as f:
+            f.write(image_utils.encode_image(pixels, image_utils.FULL_ENCODING))
+
+
+async def run_request(
+    request: Dict, client: image_client.ImageClient, scheduler: FairScheduler, source_url: str, results: List[Dict]
+):
+    template = PromptTemplate(request["prompt"])
+    cap = min(MAX_PROMPTS, client.max_prompts or MAX_PROMPTS)
+    prompts = template.page(request.get("page", 0), max(1, cap // request["count"])) * request["count"]
+    kind = request["kind"]
+    with metrics.trace(kind, user=request["user"]) as trace:
+        queued = time.time()
+        cost = scheduler.estimate_cost(len(prompts), kind)
+        async with scheduler.slot(request["user"], request.get("guild"), cost):
+            trace.add("queue_wait", time.time() - queued)
+            if kind == "img2img":
+                image_url = request["image_url"].replace("source:", source_url)
+                hparams = {"strength": request.get("strength", 80) / 100}
+                stream = client.stream_images_from_image(prompts, image_url + ".png", request["seed"], hparams)
+            else:
+                hparams = {"negative_prompt": request.get("negative_prompt")}
+                if request.get("draft"):
+                    hparams["draft"] = True
+                stream = client.stream_images(prompts, request["seed"], hparams)
+            first_progress = None
+            async for progress in stream:
+                if first_progress is None:
+                    first_progress = time.time() - trace.start
+            if progress.link == image_client.ERROR_IMAGE:
+                trace.status = "error"
+    results.append(
+        {
+            "kind": kind,
+            "images": len(prompts),
+            "latency": trace.duration,
+            "queue_wait": trace.spans.get("queue_wait", 0.0),
+            "first_progress": first_progress,
+            "error": trace.status != "ok",
+            "cache": trace.attrs.get("cache"),
+            "spans": trace.spans,
+        }
+    )
+
+
+async def sample_queue_depth(scheduler: FairScheduler, local_client: image_client.LocalGPUClient, samples: List):
+    while True:
+        stats = scheduler.stats()
+        in_flight = sum(worker.in_flight for worker in local_client.workers)
+        samples.append((stats["waiting"], stats["active"], in_flight))
+        await asyncio.sleep(SAMPLE_INTERVAL)
+
+
+async def replay(
+    requests: List[Dict], client: image_client.ImageClient, local_client: image_client.LocalGPUClient, source_url: str
+) -> Dict:
+    scheduler = FairScheduler(max_concurrent=MAX_CONCURRENT_JOBS, max_per_user=MAX_JOBS_PER_USER)
+    results: List[Dict] = []
+    samples: List = []
+    sampler = asyncio.create_task(sample_queue_depth(scheduler, local_client, samples))
+    start = time.time()
+    tasks = []
+    for request in requests:
+        delay = request["t"] / SPEEDUP - (time.time() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(run_request(request, client, scheduler, source_url, results)))
+    await asyncio.gather(*tasks)
+    sampler.cancel()
+    return {"results": results, "samples": samples, "elapsed": time.time() - start}
+
+
+def report(run: Dict, cache_stats: Optional[Dict]):
+    results, samples, elapsed = run["results"], run["samples"], run["elapsed"]
+    latencies = [r["latency"] for r in results]
+    waits = [r["queue_wait"] for r in results]
+    firsts = [r["first_progress"] for r in results if r["first_progress"] is not None]
+    images = sum(r["images"] for r in results)
+    print(f"requests {len(results)}, errors {sum(r['error'] for r in results)}, images {images}, {elapsed:.1f}s")
+    print(f"throughput {len(results) / elapsed:.2f} req/s, {images / elapsed:.2f} images/s")
+    print(f"{'':>16} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for name, values in [("latency", latencies), ("queue wait", waits), ("first progress", firsts)]:
+        row = " ".join(f"{percentile(values, q):>8.2f}" for q in (50, 95, 99, 100))
+        print(f"{name:>16} {row}")
+    waiting = [sample[0] for sample in samples]
+    in_flight = [sample[2] for sample in samples]
+    print(
+        f"queue depth mean {np.mean(waiting):.2f} max {max(waiting)}, worker jobs in flight mean {np.mean(in_flight):.2f}"
+    )
+    span_totals: Dict[str, float] = {}
+    for r in results:
+        for name, seconds in r["spans"].items():
+            span_totals[name] = span_totals.get(name, 0.0) + seconds
+    print("mean span seconds " + ", ".join(f"{k} {v / len(results):.3f}" for k, v in span_totals.items()))
+    if cache_stats is not None:
+        print(f"result cache {cache_stats}")
+
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    requests = load_workload(WORKLOAD)
+    backend_options = {"seconds_per_image": SECONDS_PER_IMAGE}
+    if MEMORY_LIMIT_GB is not None:
+        backend_options["memory_limit"] = int(float(MEMORY_LIMIT_GB) * fake_gen.GB)
+    local_client = image_client.LocalGPUClient(
+        max_batch_size=MAX_BATCH_SIZE,
+        batch_wait=BATCH_WAIT,
+        output_sink=NullSink(),
+        devices=DEVICES,
+        workers_per_device=WORKERS_PER_DEVICE,
+        backend="fake",
+        backend_options=backend_options,
+        pipeline_stages=PIPELINE_STAGES,
+    )
+    client = local_client
+    router = None
+    if SPILLOVER_DEVICES is not None:
+        remote_client = image_client.LocalGPUClient(
+            max_batch_size=MAX_BATCH_SIZE,
+            batch_wait=BATCH_WAIT,
+            output_sink=NullSink(),
+            devices=SPILLOVER_DEVICES.split(","),
+            backend="fake",
+            backend_options=backend_options,
+        )
+        # like Modal, no img2img
+        remote_client.supports_img2img = False
+        router = routing_client.RoutingClient(
+            [("local", local_client), ("remote", remote_client)],
+            max_latency=SPILLOVER_LATENCY,
+            initial_seconds_per_image=SECONDS_PER_IMAGE,
+        )
+        client = router
+    client = result_cache.CachingClient(client) if RESULT_CACHE else client
+    client.init()
+    client.warmup()
+
+    async def run() -> Dict:
+        with tempfile.TemporaryDirectory() as root_dir:
+            write_sources(requests, root_dir)
+            server = http_server.HTTPServer(host="127.0.0.1", port=HTTP_PORT)
+            server.serve_directory("/sources", root_dir)
+            await server.start()
+            try:
+                return await replay(requests, client, local_client, f"http://127.0.0.1:{HTTP_PORT}/sources/")
+            finally:
+                await local_client.image_fetcher.close()
+                await server.stop()
+
+    run_result = asyncio.run(run())
+    report(run_result, client.stats() if RESULT_CACHE else None)
+    if router is not None:
+        print(f"backends {router.stats()}")
+
+
+if __name__ == "__main__":
+    main()
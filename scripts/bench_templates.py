@@ -0,0 +1,43 @@
+from typing import List
+import timeit
+import re
+
+from diffuser_discord.bot.templates import PromptTemplate
+
+
+def _eager_expand(template: str) -> List[str]:
+    # the previous recursive expander, kept as a baseline
+    match = re.search(r"\{([^}]+)\}", template)
+    if not match:
+        return [template]
+    expanded = []
+    for option in match.group(1).split(", "):
+        expanded += _eager_expand(template[: match.start()] + option + template[match.end() :])
+    return expanded
+
+
+TEMPLATES = {
+    "small": "a {photo, painting} of a {dog, cat}",
+    "4^5": "a {red, green, blue, gold} " * 5,
+    "4^7": "a {red, green, blue, gold} " * 7,
+    "nested": "a {photo, {oil, water} painting, {pencil, charcoal} sketch} of a {dog, cat, {small, big} fox} " * 3,
+}
+
+
+def _time(fn, number: int) -> float:
+    return timeit.timeit(fn, number=number) / number * 1000
+
+
+def main():
+    print(f"{'template':>8} {'size':>8} {'eager ms':>10} {'count ms':>10} {'page ms':>10} {'sample ms':>10}")
+    for name, template in TEMPLATES.items():
+        size = PromptTemplate(template).size
+        eager = _time(lambda: _eager_expand(template), 3) if name != "nested" else float("nan")
+        count = _time(lambda: PromptTemplate(template).size, 100)
+        page = _time(lambda: PromptTemplate(template).page(7, 9), 100)
+        sample = _time(lambda: PromptTemplate(template).sample(9), 100)
+        print(f"{name:>8} {size:>8} {eager:>10.3f} {count:>10.3f} {page:>10.3f} {sample:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,72 @@ import os
 
 os.environ["FORCE_MEM_EFFICIENT_ATTN"] = "1"
 
-from diffuser_discord.bot import discord_bot, image_client
+from diffuser_discord.bot import discord_bot, image_client, http_server, result_cache, image_fetcher, job_queue
+from diffuser_discord.bot import routing_client
+from diffuser_discord.ml_worker import output_sinks, image_utils
 import logging
 
+OUTPUT_SINK = os.environ.get("OUTPUT_SINK", "imgur")
+LOCAL_OUTPUT_DIR = os.environ.get("LOCAL_OUTPUT_DIR", "outputs")
+HTTP_PORT = int(os.environ.get("HTTP_PORT", "8080"))
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", f"http://localhost:{HTTP_PORT}")
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", "results.db")
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH", "jobs.db")
+WARMUP_GENERATION = os.environ.get("WARMUP_GENERATION", "0") == "1"
+STANDBY_WORKER = os.environ.get("STANDBY_WORKER", "0") == "1"
+DEVICES = os.environ.get("DEVICES", "cuda:0").split(",")
+WORKERS_PER_DEVICE = int(os.environ.get("WORKERS_PER_DEVICE", "1"))
+PIPELINE_STAGES = os.environ.get("PIPELINE_STAGES", "0") == "1"
+MEMORY_PROFILE = os.environ.get("MEMORY_PROFILE", "balanced")
+PREVIEW_FORMAT = os.environ.get("PREVIEW_FORMAT", "WEBP")
+PREVIEW_QUALITY = int(os.environ.get("PREVIEW_QUALITY", "80"))
+PREVIEW_MAX_SIDE = int(os.environ.get("PREVIEW_MAX_SIDE", "1024"))
+FULL_FORMAT = os.environ.get("FULL_FORMAT", "PNG")
+FULL_QUALITY = os.environ.get("FULL_QUALITY", None)
+# defaults to on for the local sink and off for Imgur, where it would double the uploads
+FULL_RESOLUTION = os.environ.get("FULL_RESOLUTION", None)
+SOURCE_IMAGE_MAX_MB = float(os.environ.get("SOURCE_IMAGE_MAX_MB", "20"))
+SERVE_METRICS = os.environ.get("SERVE_METRICS", "0") == "1"
+SPILLOVER_TO_MODAL = os.environ.get("SPILLOVER_TO_MODAL", "0") == "1"
+SPILLOVER_LATENCY = float(os.environ.get("SPILLOVER_LATENCY", "30"))
+
 
 def main():
     logging.getLogger().setLevel(logging.INFO)
-    img_client = image_client.LocalGPUClient(max_image_batch_size=1)
+    server = None
+    if OUTPUT_SINK == "local" or SERVE_METRICS:
+        server = http_server.HTTPServer(port=HTTP_PORT)
+    if SERVE_METRICS:
+        server.serve_metrics("/metrics")
+    if OUTPUT_SINK == "local":
+        sink = output_sinks.LocalFileSink(LOCAL_OUTPUT_DIR, PUBLIC_BASE_URL + "/images")
+        server.serve_directory("/images", LOCAL_OUTPUT_DIR)
+    else:
+        sink = output_sinks.ImgurSink()
+    local_client = image_client.LocalGPUClient(
+        output_sink=sink,
+        warmup_generation=WARMUP_GENERATION,
+        standby=STANDBY_WORKER,
+        devices=DEVICES,
+        workers_per_device=WORKERS_PER_DEVICE,
+        pipeline_stages=PIPELINE_STAGES,
+        memory_profile=MEMORY_PROFILE,
+        preview_encoding=image_utils.EncodeSettings(PREVIEW_FORMAT, PREVIEW_QUALITY, PREVIEW_MAX_SIDE),
+        full_encoding=image_utils.EncodeSettings(FULL_FORMAT, FULL_QUALITY and int(FULL_QUALITY)),
+        full_resolution=None if FULL_RESOLUTION is None else FULL_RESOLUTION == "1",
+        image_fetcher=image_fetcher.ImageFetcher(max_bytes=int(SOURCE_IMAGE_MAX_MB * 1024**2)),
+    )
+    backend = local_client
+    if SPILLOVER_TO_MODAL:
+        backend = routing_client.RoutingClient(
+            [("local", local_client), ("modal", image_client.ModalClient())], max_latency=SPILLOVER_LATENCY
+        )
+    img_client = result_cache.CachingClient(backend, RESULT_CACHE_PATH)
     img_client.init()
-    discord_client = discord_bot.create_discord_client(img_client=img_client)
+    img_client.warmup()
+    discord_client = discord_bot.create_discord_client(
+        img_client=img_client, http_server=server, job_queue=job_queue.JobQueue(JOB_QUEUE_PATH)
+    )
     discord_client.run(os.environ["DISCORD_TOKEN"])
 
 
@@ -1,14 +1,19 @@
 import os
 
-from diffuser_discord.bot import discord_bot, image_client
+from diffuser_discord.bot import discord_bot, image_client, result_cache, job_queue
 import logging
 
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", "results.db")
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH", "jobs.db")
+
 
 def main():
     logging.getLogger().setLevel(logging.INFO)
-    img_client = image_client.ModalClient()
+    img_client = result_cache.CachingClient(image_client.ModalClient(), RESULT_CACHE_PATH)
     img_client.init()
-    discord_client = discord_bot.create_discord_client(img_client=img_client)
+    discord_client = discord_bot.create_discord_client(
+        img_client=img_client, job_queue=job_queue.JobQueue(JOB_QUEUE_PATH)
+    )
     discord_client.run(os.environ["DISCORD_TOKEN"])
 
 